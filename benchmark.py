@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import main
+from partitioning_algorithm import partition_iax, partition_iax_single
+from partitioning_order import create_directed_graph, get_partitioning_order
+from synthetic_data import write_synthetic_dataset
+from utils import load_df, load_df_mmap, get_soma_currents_dataframes, get_itotal_dataframes, get_aggregation_codes, aggregate_currents
+
+
+def time_call(fn, repeats: int) -> dict:
+    """
+    Times a function call.
+
+    Parameters:
+        fn (callable): The function to time (called without arguments).
+        repeats (int): The number of timed calls.
+
+    Returns:
+        dict: The wall times of all calls in seconds, with their minimum and median.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'times': times, 'min': min(times), 'median': statistics.median(times)}
+
+
+def benchmark_dataset(data_dir: str, n_segments: int, branching: float, itypes_per_segment: int, n_timepoints: int,
+                      sign_flip_rate: float, engines: list[str], pandas_timepoints: int, repeats: int, seed: int) -> list[dict]:
+    """
+    Generates a synthetic dataset and times every stage of the pipeline on it.
+
+    Parameters:
+        data_dir (str): The directory for the synthetic dataset and the outputs of `process_file_pair`.
+        n_segments (int): The number of segments of the synthetic tree.
+        branching (float): The branching probability of the synthetic tree.
+        itypes_per_segment (int): The number of itypes of every segment.
+        n_timepoints (int): The number of timepoints.
+        sign_flip_rate (float): The sign flip probability of the currents between timepoints.
+        engines (list[str]): The `partition_iax` engines to time on all timepoints.
+        pandas_timepoints (int): The number of timepoints for the (slow) "pandas" engine.
+        repeats (int): The number of timed calls of every stage.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        list[dict]: One record per timed stage.
+    """
+    paths = write_synthetic_dataset(data_dir, n_segments, branching, itypes_per_segment, n_timepoints, sign_flip_rate, seed=seed)
+    iax_file = os.path.join(paths['iax_dir'], 'merged_soma_values_0.npy')
+    im_file = os.path.join(paths['im_dir'], 'merged_soma_values_0.npy')
+    df_iax = load_df(paths['iax_index_file'], iax_file)
+    df_im = load_df(paths['im_index_file'], im_file)
+    dataset = {'n_segments': n_segments, 'n_edges': len(df_iax), 'n_im_rows': len(df_im), 'branching': branching,
+               'itypes_per_segment': itypes_per_segment, 'sign_flip_rate': sign_flip_rate}
+
+    records = []
+
+    def record(stage, fn, timepoints=None, engine=None):
+        result = time_call(fn, repeats)
+        if timepoints:
+            result['per_timepoint'] = result['median'] / timepoints
+        records.append({'stage': stage, 'engine': engine, 'n_timepoints': timepoints, **dataset, **result})
+
+    record('load_df', lambda: (load_df(paths['iax_index_file'], iax_file), load_df(paths['im_index_file'], im_file)))
+    record('load_df_mmap', lambda: (load_df_mmap(paths['iax_index_file'], iax_file), load_df_mmap(paths['im_index_file'], im_file)))
+
+    dg = create_directed_graph(df_iax, 0)
+    record('create_directed_graph', lambda: create_directed_graph(df_iax, 0), timepoints=1)
+    record('get_partitioning_order', lambda: (get_partitioning_order(dg, 'soma', 'out'), get_partitioning_order(dg, 'soma', 'in')), timepoints=1)
+    order_out = get_partitioning_order(dg, 'soma', 'out')
+    if order_out:
+        ref, par = order_out[0]
+        im_pos = df_im.clip(lower=0)
+        record('partition_iax_single', lambda: partition_iax_single(ref, par, 0, im_pos, df_iax))
+
+    for engine in ['pandas'] + [engine for engine in engines if engine != 'pandas']:
+        timepoints = list(range(min(pandas_timepoints, n_timepoints) if engine == 'pandas' else n_timepoints))
+        record('partition_iax', lambda: partition_iax(df_im, df_iax, timepoints, 'soma', engine=engine), timepoints=len(timepoints), engine=engine)
+
+    record('get_soma_currents_dataframes', lambda: get_soma_currents_dataframes(df_im, df_iax), timepoints=n_timepoints)
+    record('get_itotal_dataframes', lambda: get_itotal_dataframes(df_im), timepoints=n_timepoints)
+    aggregation_codes = get_aggregation_codes(df_im.index, df_iax.index)
+    record('aggregate_currents', lambda: aggregate_currents(df_im, df_iax, aggregation_codes), timepoints=n_timepoints)
+
+    # Synthetic currents are random, so a child may have no membrane current of the sign needed to partition its
+    # axial current, which breaks the conservation identity at that timepoint, the errors are only reported
+    main.conservation_tolerance = None
+    record('process_file_pair', lambda: main.process_file_pair(im_file, iax_file, paths['im_index_file'], paths['iax_index_file'],
+                                                               os.path.join(data_dir, 'outputs')), timepoints=n_timepoints)
+    return records
+
+
+def run_benchmarks(segment_counts: list[int], branching: float, itypes_per_segment: int, n_timepoints: int,
+                   sign_flip_rate: float, engines: list[str], pandas_timepoints: int, repeats: int, seed: int) -> dict:
+    """
+    Runs `benchmark_dataset` for every number of segments and collects the results with the environment.
+
+    Returns:
+        dict: The environment, the parameters and the records of all datasets.
+    """
+    results = []
+    for n_segments in segment_counts:
+        with tempfile.TemporaryDirectory() as data_dir:
+            results += benchmark_dataset(data_dir, n_segments, branching, itypes_per_segment, n_timepoints,
+                                         sign_flip_rate, engines, pandas_timepoints, repeats, seed)
+    environment = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                   'machine': platform.machine(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+                   'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    parameters = {'segment_counts': segment_counts, 'branching': branching, 'itypes_per_segment': itypes_per_segment,
+                  'n_timepoints': n_timepoints, 'sign_flip_rate': sign_flip_rate, 'engines': engines,
+                  'pandas_timepoints': pandas_timepoints, 'repeats': repeats, 'seed': seed}
+    return {'environment': environment, 'parameters': parameters, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the partitioning pipeline on synthetic neuron trees.')
+    parser.add_argument('--segments', type=int, nargs='+', default=[100, 400, 1400], help='numbers of segments')
+    parser.add_argument('--branching', type=float, default=0.1, help='probability of starting a new branch')
+    parser.add_argument('--itypes', type=int, default=4, help='number of itypes per segment')
+    parser.add_argument('--timepoints', type=int, default=200, help='number of timepoints')
+    parser.add_argument('--flip-rate', type=float, default=0.01, help='sign flip probability between timepoints')
+    parser.add_argument('--engines', nargs='+', default=['array', 'batched', 'compact'], help='partition_iax engines')
+    parser.add_argument('--pandas-timepoints', type=int, default=2, help='timepoints for the pandas engine')
+    parser.add_argument('--repeats', type=int, default=3, help='timed calls per stage')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--output', default='benchmark_results.json', help='path of the JSON results')
+    args = parser.parse_args()
+
+    benchmark = run_benchmarks(args.segments, args.branching, args.itypes, args.timepoints, args.flip_rate,
+                               args.engines, args.pandas_timepoints, args.repeats, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(benchmark, f, indent=2)
+    for result in benchmark['results']:
+        print(f"{result['n_segments']:>6} {result['stage']:<30} {result['engine'] or '':<8} {result['median']:.4f} s")
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from output_writer import iter_output, read_csv_output
+
+FINGERPRINT_DIR = 'fingerprints'
+PREVIOUS_SUFFIX = '.previous'
+# Changed whenever the partitioned currents of unchanged inputs change, so outputs of older versions are recomputed
+FINGERPRINT_VERSION = 1
+
+
+def get_column_fingerprints(values: np.ndarray) -> np.ndarray:
+    """
+    Hashes every column (timepoint) of an array, copying at most one column at a time.
+
+    Parameters:
+        values (np.ndarray): The (row, timepoint) currents.
+
+    Returns:
+        np.ndarray: The 16-byte BLAKE2b digest of every column.
+    """
+    return np.array([hashlib.blake2b(np.ascontiguousarray(values[:, j]), digest_size=16).digest() for j in range(values.shape[1])],
+                    dtype='S16')
+
+
+def get_context_fingerprint(im_index_file: str, iax_index_file: str, segment: str, dtype: np.dtype, engine: str) -> str:
+    """
+    Hashes everything besides the values of a timepoint that its outputs depend on: the multiindex files (the tree
+    and the itypes), the target segment, the dtype of the currents, the partitioning engine and `FINGERPRINT_VERSION`.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for fname in [im_index_file, iax_index_file]:
+        with open(fname, 'rb') as f:
+            digest.update(f.read())
+    digest.update(f'\n{segment}\n{np.dtype(dtype).str}\n{engine}\n{FINGERPRINT_VERSION}'.encode())
+    return digest.hexdigest()
+
+
+def get_fingerprint_path(output_dir: str, file_number: str) -> str:
+    """Returns the path of the fingerprints of the outputs of a file pair."""
+    return os.path.join(output_dir, FINGERPRINT_DIR, f'fingerprints_{file_number}.npz')
+
+
+def get_stored_path(path: str) -> str:
+    """Returns the directory or CSV file of a table written by `output_writer.get_output_writer`, or None."""
+    if os.path.isdir(path):
+        return path
+    return path + '.csv' if os.path.exists(path + '.csv') else None
+
+
+def remove_path(path: str) -> None:
+    """Removes a file or directory, if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def stash_previous_outputs(table_paths: dict[str, str], fingerprint_path: str) -> dict[str, str]:
+    """
+    Moves the outputs of a previous run aside (`<table>.previous`), so they are read while the new tables are written.
+
+    The fingerprints are moved last: once `<fingerprints>.previous` exists, the previous tables are complete and
+    consistent with it. Previous outputs of an interrupted run are kept, as the current tables may already be
+    partially rewritten.
+
+    Parameters:
+        table_paths (dict[str, str]): The output path (without file extension) of every table.
+        fingerprint_path (str): The path of the fingerprints of the tables.
+
+    Returns:
+        dict[str, str]: The previous table of every table, None if there are no complete previous outputs.
+    """
+    if not os.path.exists(fingerprint_path + PREVIOUS_SUFFIX):
+        if not os.path.exists(fingerprint_path):
+            return None
+        for path in table_paths.values():
+            stored = get_stored_path(path)
+            if stored is not None:
+                remove_path(stored + PREVIOUS_SUFFIX)
+                os.replace(stored, stored + PREVIOUS_SUFFIX)
+        os.replace(fingerprint_path, fingerprint_path + PREVIOUS_SUFFIX)
+
+    previous = {}
+    for name, path in table_paths.items():
+        candidates = [stored + PREVIOUS_SUFFIX for stored in [path, path + '.csv'] if os.path.exists(stored + PREVIOUS_SUFFIX)]
+        if not candidates:
+            return None
+        previous[name] = candidates[0]
+    return previous
+
+
+def discard_previous_outputs(table_paths: dict[str, str], fingerprint_path: str) -> None:
+    """Removes the outputs moved aside by `stash_previous_outputs`, once the new outputs are complete."""
+    remove_path(fingerprint_path + PREVIOUS_SUFFIX)
+    for path in table_paths.values():
+        remove_path(path + PREVIOUS_SUFFIX)
+        remove_path(path + '.csv' + PREVIOUS_SUFFIX)
+
+
+def read_fingerprints(path: str) -> dict:
+    """
+    Reads the fingerprints of the outputs of a file pair.
+
+    Returns:
+        dict: The context fingerprint ("context", see `get_context_fingerprint`) and, per timepoint ("timepoints"), the
+        fingerprints of the membrane ("im") and axial ("iax") currents and the relative conservation errors ("errors",
+        sign x timepoint).
+    """
+    with open(path, 'rb') as f, np.load(f, allow_pickle=False) as fingerprints:
+        result = {name: fingerprints[name] for name in fingerprints.files}
+    result['context'] = str(result['context'])
+    return result
+
+
+def write_fingerprints(path: str, context: str, timepoints: list, im: np.ndarray, iax: np.ndarray, errors: np.ndarray) -> None:
+    """Writes the fingerprints of the outputs of a file pair atomically, see `read_fingerprints`."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as tmp:
+        np.savez(tmp, context=np.array(context), timepoints=np.asarray(timepoints), im=im, iax=iax, errors=errors)
+    os.replace(tmp.name, path)
+
+
+class PreviousTable:
+    """
+    Reads columns (timepoints) of a table of a previous run by their label, without loading the binary chunks.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+            path (str): The table (a chunk directory or a CSV file) moved aside by `stash_previous_outputs`.
+        """
+        # Binary chunks stay memory-mapped, a CSV file is read at once
+        chunks = list(iter_output(path, mmap_mode='r')) if os.path.isdir(path) else [read_csv_output(path)]
+        self.index = chunks[0].index if chunks else None
+        self.chunks = [chunk.to_numpy() for chunk in chunks]
+        self.positions = {label: (i, j) for i, chunk in enumerate(chunks) for j, label in enumerate(chunk.columns)}
+
+    def get(self, timepoints: list) -> np.ndarray:
+        """Returns the (row, timepoint) values of the given timepoints, which must be columns of the table."""
+        return np.column_stack([self.chunks[i][:, j] for i, j in (self.positions[tp] for tp in timepoints)])
+
+
+def splice_columns(computed: pd.DataFrame, previous: PreviousTable, reused: np.ndarray, timepoints: list) -> pd.DataFrame:
+    """
+    Combines the recomputed timepoints of a window with the reused timepoints of the previous table.
+
+    Parameters:
+        computed (DataFrame): The recomputed timepoints (the timepoints not reused, in order), None if all are reused.
+        previous (PreviousTable): The previous table.
+        reused (np.ndarray): Whether each timepoint of the window is reused.
+        timepoints (list): The timepoints of the window.
+
+    Returns:
+        DataFrame: The table of all timepoints of the window.
+    """
+    if not reused.any():
+        return computed
+    reused_values = previous.get([tp for tp, is_reused in zip(timepoints, reused) if is_reused])
+    if computed is None:
+        return pd.DataFrame(reused_values, index=previous.index, columns=timepoints)
+    values = np.empty((len(computed), len(timepoints)), dtype=np.result_type(computed.to_numpy().dtype, reused_values.dtype))
+    values[:, ~reused] = computed.to_numpy()
+    values[:, reused] = reused_values
+    return pd.DataFrame(values, index=computed.index, columns=timepoints)
@@ -0,0 +1,138 @@
+import contextlib
+import cProfile
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_active = None
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Instrumentation:
+    """
+    Collects wall time, call counts and memory of the stages of the pipeline (e.g. "load", "graph", "traversal",
+    "partitioning", "aggregation", "validation", "write"). Stages must not be nested.
+
+    For every stage it records the number of calls, the total wall time, the largest resident set size seen at the
+    end of a call, and by how much the peak resident set size of the process grew during the stage (both only where
+    the resident set size is available, see `get_max_rss`). With
+    `trace_memory`, the peak of the memory allocated during a call (traced with tracemalloc) is recorded as well.
+    """
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Times the enclosed block as a call of the stage `name`."""
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        max_rss_before = get_max_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self.stages.setdefault(name, {'calls': 0, 'wall_time': 0.0})
+            stats['calls'] += 1
+            stats['wall_time'] += elapsed
+            if max_rss_before is not None:
+                stats['peak_rss'] = max(stats.get('peak_rss', 0), get_current_rss())
+                stats['max_rss_increase'] = stats.get('max_rss_increase', 0) + get_max_rss() - max_rss_before
+            if self.trace_memory:
+                stats['peak_traced'] = max(stats.get('peak_traced', 0), tracemalloc.get_traced_memory()[1] - traced_before)
+
+    def summary(self) -> dict:
+        """Returns the JSON-serializable summary of all stages."""
+        return {'wall_time': time.perf_counter() - self.start, 'max_rss': get_max_rss(), 'stages': self.stages}
+
+
+def stage(name: str):
+    """
+    Times the enclosed block as a stage of the active instrumentation (see `instrument`).
+
+    Without active instrumentation, a shared no-op context manager is returned.
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name)
+
+
+@contextlib.contextmanager
+def instrument(enabled: bool = True, trace_memory: bool = False, profile_path: str = None):
+    """
+    Activates instrumentation for the enclosed block.
+
+    Parameters:
+        enabled (bool): Whether to collect anything. If False, `None` is yielded and `stage` stays a no-op.
+        trace_memory (bool): Whether to trace the memory allocated in every stage with tracemalloc (slow).
+        profile_path (str, optional): If given, the block is profiled with cProfile and the statistics are dumped
+                                      to this path (readable with `pstats`).
+
+    Yields:
+        Instrumentation: The instrumentation collecting the stages, or `None` if disabled.
+    """
+    global _active
+    if not enabled:
+        yield None
+        return
+
+    previous, _active = _active, Instrumentation(trace_memory)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield _active
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if started_tracing:
+            tracemalloc.stop()
+        _active = previous
+
+
+def get_current_rss() -> int:
+    """Returns the current resident set size of the process in bytes (the peak one where it is not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().rss
+    return get_max_rss()
+
+
+def get_max_rss() -> int:
+    """
+    Returns the peak resident set size of the process in bytes.
+
+    Without the `resource` module (on Windows), the peak working set is read with `psutil` if it is installed,
+    otherwise None is returned and the resident set size is not reported.
+    """
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory_info = psutil.Process().memory_info()
+        return getattr(memory_info, 'peak_wset', memory_info.rss)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
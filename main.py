@@ -1,90 +1,320 @@
-from concurrent.futures import ProcessPoolExecutor
-import glob
+import argparse
+import json
 import os
-from utils import load_df, get_soma_currents_dataframes, get_itotal_dataframes
-from partitioning_algorithm import partition_iax
+import socket
+import sys
+from contextlib import ExitStack, closing
+from dataclasses import asdict, replace
+import numpy as np
+from instrumentation import instrument, stage
+from utils import load_df_mmap, get_aggregation_codes, aggregate_currents, get_conservation_errors, check_conservation
+from partitioning_algorithm import partition_iax, encode_im, get_order_cache, TimepointPool
+from output_writer import get_output_writer
+from pipeline import BackgroundWriter, prefetch
+from incremental import (PREVIOUS_SUFFIX, PreviousTable, discard_previous_outputs, get_column_fingerprints, get_context_fingerprint,
+                         get_fingerprint_path, read_fingerprints, remove_path, splice_columns, stash_previous_outputs,
+                         write_fingerprints)
+from scheduler import JobResult, run_jobs
+from sharding import (OUTPUT_TABLES, SHARD_RECORD, SHARDS_DIR, check_shards, claim_shard, create_shard_manifest, extract_file_number,
+                      get_shard_dir, get_table_path, merge_shards, read_json, read_shard_lock, release_shard, write_json)
 
-input_dir = 'E:/cluster_seed30/preprocessed_data'
-output_dir = 'E:/cluster_seed30/partitioned_data'
+# The input and output directories, the target segment, the timepoints and the parallel files are command-line
+# arguments (see `main`)
+timepoint_workers = 1  # processes partitioning the timepoints of each file, sharing its memory-mapped values (1: in the file's process)
+memory_budget = None  # approximate peak memory per file in bytes (e.g. 4 * 1024**3), None uses windows of `window_timepoints`
+window_timepoints = 256  # timepoints per window without a memory_budget, so reading, partitioning and writing overlap
+prefetch_depth = 1  # windows of timepoints read ahead in a background thread while the current one is processed (0: no prefetching)
+write_queue_size = 2  # chunks per output table queued for a background writer thread (0: write in the processing thread)
+output_format = 'npy'  # binary chunks readable with output_writer.read_output, 'csv' to export text CSV files
+conservation_tolerance = 1e-2  # maximum relative error of the partitioned soma currents, None only reports the error
+instrument_stages = True  # per-stage wall time, call counts and memory, returned by process_file_pair and kept in the manifest
+profile_file_number = None  # file number to run under cProfile and tracemalloc (profile_<number>.prof in the output directory)
+incremental = False  # reuse the outputs of the timepoints whose currents are unchanged since the last run into the same output directory
 
-# Ensure the output directories exist
-partitioned_dir = os.path.join(output_dir, 'partitioned_currents')
-itotal_dir = os.path.join(output_dir, 'total_currents')
-soma_dir = os.path.join(output_dir, 'soma_currents')
 
-os.makedirs(partitioned_dir, exist_ok=True)
-os.makedirs(itotal_dir, exist_ok=True)
-os.makedirs(soma_dir, exist_ok=True)
+def get_bytes_per_timepoint(n_im_rows, n_iax_rows, itemsize):
+    """
+    Estimate the peak memory of processing a file pair per timepoint of a window in bytes.
 
-iax_index_file = input_dir + '/axial_currents_merged_soma/multiindex_merged_soma.csv'
-iax_values_files = glob.glob(input_dir + '/axial_currents_merged_soma/*.npy')
+    The estimate accounts for the window of the membrane and axial currents read from disk (plus the windows read
+    ahead, see `prefetch_depth`) and the block copy and the clipped copies (the compact slabs) of the partitioning
+    engine (the aggregation does not copy the window).
+    """
+    n_windows = 1 + prefetch_depth + (1 if prefetch_depth else 0)  # the processed window, the waiting windows and the window being read
+    return itemsize * ((n_windows + 3) * n_im_rows + (n_windows + 1) * n_iax_rows)
 
-im_index_file = input_dir + '/membrane_currents_merged_soma/multiindex_merged_soma.csv'
-im_values_files = glob.glob(input_dir + '/membrane_currents_merged_soma/*.npy')
 
-segment = 'soma'
-batch_size = 1 #  number of files to process parallel
+def get_window_size(df_im, df_iax, memory_budget):
+    """Estimate the number of timepoints (columns) that can be processed at once within the memory budget."""
+    return max(1, memory_budget // get_bytes_per_timepoint(len(df_im), len(df_iax), df_im.to_numpy().dtype.itemsize))
 
 
-def extract_file_number(filepath):
-    """Extract the number from the file name."""
-    filename = os.path.basename(filepath)
-    number = ''.join(filter(str.isdigit, filename))
-    return number
+def process_file_pair(im_file, iax_file, im_index_file, iax_index_file, output_dir, segment='soma', start=0, stop=None):
+    """
+    Partition, aggregate and write the currents of the timepoints `start <= t < stop` of a file pair window by window.
 
+    The tables are written to `output_dir` (see `sharding.get_table_path`), the currents are partitioned for the
+    target `segment` (`stop=None` processes all timepoints after `start`). With `incremental`, the membrane and axial
+    currents of every timepoint are fingerprinted next to the tables (see `incremental`), the timepoints whose
+    currents (and index files and segment) are unchanged since the previous incremental run into `output_dir` are
+    copied from the previous tables, and only the other timepoints are partitioned and aggregated.
+    The summed partitioned currents are compared with the summed soma membrane and axial currents at every
+    timepoint (the identity of `utils.plot_sums`), and the result records whether the maximum relative error is within
+    `conservation_tolerance` (the file is not failed here, so its outputs and result are recorded either way, see
+    `run_shard`). Returns the file number, the maximum and mean relative error and, if `instrument_stages` is enabled,
+    the per-stage summary of the instrumentation (see `instrumentation.Instrumentation`).
+    """
+    # Log the files being processed to stderr, stdout only holds the JSON records of the command line
+    print(f"Reading and processing files: im = {im_file}, iax = {iax_file}, timepoints = {start}:{stop}", file=sys.stderr)
+    # Extract file numbers
+    im_number = extract_file_number(im_file)
 
-def process_file_pair(im_file, iax_file):
-    # Log the files being processed
-    print(f"Reading and processing files: im = {im_file}, iax = {iax_file}")
-    # Load data for the given pair of files
-    df_iax = load_df(iax_index_file, iax_file)
-    df_im = load_df(im_index_file, im_file)
+    profile = profile_file_number is not None and im_number == str(profile_file_number)
+    profile_path = os.path.join(output_dir, f'profile_{im_number}.prof') if profile else None
+    with instrument(instrument_stages or profile, trace_memory=profile, profile_path=profile_path) as recorder, ExitStack() as resources:
+        # Load data for the given pair of files (memory-mapped, columns are read window by window)
+        with stage('load'):
+            df_iax = load_df_mmap(iax_index_file, iax_file)
+            df_im = load_df_mmap(im_index_file, im_file)
+        with stage('aggregation'):
+            aggregation_codes = get_aggregation_codes(df_im.index, df_iax.index, segment)
 
-    # Perform the partitioning algorithm
-    im_part_pos, im_part_neg = partition_iax(df_im, df_iax, timepoints=list(range(50,52)), target=segment)
-    # to test on smaller data: timepoints=list(range(50,52))
-    # process full dataset: timepoints=df_iax.columns
+        # Partitioned, soma and total currents are written window by window
+        for directory in set(OUTPUT_TABLES.values()):
+            os.makedirs(os.path.join(output_dir, directory), exist_ok=True)
+        table_paths = {name: get_table_path(output_dir, name, im_number) for name in OUTPUT_TABLES}
+        fingerprint_path = get_fingerprint_path(output_dir, im_number)
+        with stage('fingerprint'):
+            if incremental:
+                context = get_context_fingerprint(im_index_file, iax_index_file, segment, df_im.to_numpy().dtype, 'compact')
+                # The previous tables are moved aside and read while the new ones are written
+                previous = stash_previous_outputs(table_paths, fingerprint_path)
+            else:
+                # Fingerprints of an earlier incremental run would not describe the rewritten tables
+                previous = None
+                discard_previous_outputs(table_paths, fingerprint_path)
+                remove_path(fingerprint_path)
+            previous_tables = {}
+            if previous:
+                previous_fingerprints = read_fingerprints(fingerprint_path + PREVIOUS_SUFFIX)
+                if previous_fingerprints['context'] == context:
+                    previous_positions = {tp: i for i, tp in enumerate(previous_fingerprints['timepoints'].tolist())}
+                    previous_tables = {name: PreviousTable(path) for name, path in previous.items()}
+                else:
+                    previous = None
+        writers = {name: get_output_writer(path, output_format) for name, path in table_paths.items()}
+        if write_queue_size > 0:
+            writers = {name: BackgroundWriter(writer, write_queue_size) for name, writer in writers.items()}
 
-    # Extract file numbers
-    im_number = extract_file_number(im_file)
+        conservation_errors, processed_tps, im_fingerprints, iax_fingerprints = [], [], [], []
+        n_reused = 0
+        stop = df_im.shape[1] if stop is None else min(stop, df_im.shape[1])
+        window_size = window_timepoints if memory_budget is None else get_window_size(df_im, df_iax, memory_budget)
+        # The workers read the timepoints of every window from the memory-mapped files themselves
+        pool = resources.enter_context(TimepointPool(df_im, df_iax, segment, timepoint_workers, 'compact', block_size=window_size)) if timepoint_workers > 1 else None
+        # Otherwise the tree is rooted once per file, and the partitioning orders are shared by all windows
+        order_cache = get_order_cache(None, df_iax, encode_im(df_im)[2], segment) if pool is None else None
+        # The next windows are read from disk (copied into memory) in a background thread, a single window is
+        # processed on the memory-mapped values instead. The stages measure the time spent waiting for windows and for
+        # queued writes
+        starts = range(start, stop, window_size)
+        read_ahead = len(starts) > 1
+        windows = resources.enter_context(closing(prefetch(
+            starts, lambda window_start: (df_im.iloc[:, window_start:min(window_start + window_size, stop)].copy(deep=read_ahead),
+                                          df_iax.iloc[:, window_start:min(window_start + window_size, stop)].copy(deep=read_ahead)),
+            prefetch_depth if read_ahead else 0)))
+        for _ in starts:
+            with stage('load'):
+                df_im_window, df_iax_window = next(windows)
+
+            # Only the timepoints with changed currents are recomputed, the others are copied from the previous tables
+            window_tps = df_im_window.columns.tolist()
+            processed_tps += window_tps
+            positions = np.array([previous_positions.get(tp, -1) for tp in window_tps] if previous else [-1] * len(window_tps), dtype=int)
+            reused = positions >= 0
+            if incremental:
+                with stage('fingerprint'):
+                    im_fingerprints.append(get_column_fingerprints(df_im_window.to_numpy()))
+                    iax_fingerprints.append(get_column_fingerprints(df_iax_window.to_numpy()))
+                    if reused.any():
+                        reused[reused] = ((previous_fingerprints['im'][positions[reused]] == im_fingerprints[-1][reused]) &
+                                          (previous_fingerprints['iax'][positions[reused]] == iax_fingerprints[-1][reused]))
+            changed_tps = [tp for tp, is_reused in zip(window_tps, reused) if not is_reused]
+            n_reused += int(reused.sum())
+            if reused.any() and changed_tps:
+                df_im_window, df_iax_window = df_im_window.loc[:, changed_tps], df_iax_window.loc[:, changed_tps]
+
+            tables = dict.fromkeys(OUTPUT_TABLES)
+            window_errors = np.empty((2, len(window_tps)))
+            if changed_tps:
+                # Perform the partitioning algorithm on the timepoints within the window
+                if pool:
+                    with stage('partitioning'):
+                        tables['im_part_pos'], tables['im_part_neg'] = pool.partition(changed_tps)
+                else:
+                    tables['im_part_pos'], tables['im_part_neg'] = partition_iax(df_im_window, df_iax_window, timepoints=changed_tps, target=segment,
+                                                                                 engine='compact', block_size=window_size, order_cache=order_cache)
+
+                # Calculate itotal and soma currents in a single pass over the window
+                with stage('aggregation'):
+                    tables['itotal_pos'], tables['itotal_neg'], tables['soma_pos'], tables['soma_neg'] = aggregate_currents(df_im_window, df_iax_window, aggregation_codes)
+
+                # Check the conservation of the partitioned currents
+                with stage('validation'):
+                    window_errors[:, ~reused] = get_conservation_errors(tables['im_part_pos'], tables['im_part_neg'],
+                                                                        tables['soma_pos'], tables['soma_neg'])
+            if reused.any():
+                window_errors[:, reused] = previous_fingerprints['errors'][:, positions[reused]]
+            conservation_errors.append(window_errors)
+
+            with stage('write'):
+                for name, writer in writers.items():
+                    writer.append(splice_columns(tables[name], previous_tables[name], reused, window_tps) if reused.any() else tables[name])
+
+        with stage('write'):
+            for writer in writers.values():
+                writer.close()
+            # The fingerprints are written last, the previous tables are only discarded once the new ones are complete
+            # (and no longer memory-mapped)
+            previous_tables.clear()
+            conservation_errors = np.concatenate(conservation_errors, axis=1) if conservation_errors else np.empty((2, 0))
+            conservation = check_conservation(conservation_errors, conservation_tolerance, strict=False)
+            if incremental:
+                write_fingerprints(fingerprint_path, context, processed_tps,
+                                   np.concatenate(im_fingerprints) if im_fingerprints else np.empty(0, dtype='S16'),
+                                   np.concatenate(iax_fingerprints) if iax_fingerprints else np.empty(0, dtype='S16'), conservation_errors)
+                discard_previous_outputs(table_paths, fingerprint_path)
+
+    result = {'file_number': im_number}
+    if recorder:
+        result.update(recorder.summary())
+    result['incremental'] = {'reused': n_reused, 'recomputed': len(processed_tps) - n_reused}
+    result['conservation'] = conservation
+    return result
+
+
+def estimate_job_memory(im_file, iax_file):
+    """Estimate the peak memory of processing a file pair in bytes."""
+    if memory_budget is not None:
+        return memory_budget
+    # Only the headers of the files are read
+    im, iax = np.load(im_file, mmap_mode='r'), np.load(iax_file, mmap_mode='r')
+    return min(window_timepoints, im.shape[1]) * get_bytes_per_timepoint(im.shape[0], iax.shape[0], im.dtype.itemsize)
+
+
+def run_shard(shard, shard_dir, im_index_file, iax_index_file, segment='soma'):
+    """
+    Process the timepoints of a shard into its directory and record its completion.
+
+    The shard is claimed first (see `sharding.claim_shard`), so a shard is never processed by two nodes at once: a
+    shard claimed by another process is not processed (returning the claim as "claimed_by"), nor is a shard completed
+    since it was selected (returning "completed"). The completion record (`shard.json`, with the shard and the result
+    of `process_file_pair`) is removed first and written last, before the claim is released, so the shard only counts
+    as completed (see `sharding.check_shards`) once all of its tables are written. A shard failing the conservation
+    check is recorded as completed (rerunning it gives the same result) and reported as failed by `check_shards` and
+    `merge_shards`, but the job still fails.
+    """
+    if not claim_shard(shard_dir):
+        return {'claimed_by': read_shard_lock(shard_dir)}
+    try:
+        record_path = os.path.join(shard_dir, SHARD_RECORD)
+        if os.path.exists(record_path):
+            if read_json(record_path)['shard'] == shard:
+                return {'completed': True}
+            os.remove(record_path)
+        result = process_file_pair(shard['im_file'], shard['iax_file'], im_index_file, iax_index_file, shard_dir, segment,
+                                   shard['start'], shard['stop'])
+        write_json({'shard': shard, 'result': result}, record_path)
+    finally:
+        release_shard(shard_dir)
+    conservation = result['conservation']
+    if not conservation.get('passed', True):
+        raise ValueError(f"The maximum relative conservation error of shard {shard['shard_id']} "
+                         f"{conservation['max_relative_error']:.3g} exceeds the tolerance {conservation['tolerance']:.3g}")
+    return result
+
+
+def run_shards(manifest_path, shard_ids=None, max_workers=1):
+    """
+    Process the shards of a manifest on a persistent worker pool, skipping the completed shards.
+
+    Every node sharing the output directory can run any subset of the shards, shards claimed by another node are
+    reported as "claimed" (see `run_shard`). The number of concurrent shards is limited by `max_workers` and by the
+    estimated memory of each file. The results are also recorded in a job log per host (`jobs_<host>.jsonl` in the
+    shard directory); whether a shard is completed is only decided by its completion record.
+    """
+    manifest = read_json(manifest_path)
+    shards = {shard['shard_id']: shard for shard in manifest['shards']}
+    unknown = [shard_id for shard_id in shard_ids or [] if shard_id not in shards]
+    if unknown:
+        raise ValueError(f"Shards not in {manifest_path}: {unknown}")
+    status = check_shards(manifest)
+    selected = [shards[shard_id] for shard_id in shard_ids or shards]
+    jobs = [(shard['shard_id'], (shard, get_shard_dir(manifest, shard['shard_id']), manifest['im_index_file'],
+                                 manifest['iax_index_file'], manifest['segment']))
+            for shard in selected if shard['shard_id'] not in status['completed'] + status['claimed']]
+    memory_per_job = max((estimate_job_memory(shard['im_file'], shard['iax_file']) for shard in selected), default=None)
+
+    jobs_path = os.path.join(manifest['output_dir'], SHARDS_DIR, f'jobs_{socket.gethostname()}.jsonl')
+    results = {result.job_id: result for result in run_jobs(jobs, run_shard, jobs_path, max_workers=max_workers,
+                                                            memory_per_job=memory_per_job, resume=False)}
+    for job_id, result in results.items():
+        if 'claimed_by' in result.details:
+            results[job_id] = replace(result, status='claimed')
+        elif 'completed' in result.details:
+            results[job_id] = replace(result, status='skipped')
+    for shard_id in status['claimed']:
+        results.setdefault(shard_id, JobResult(shard_id, 'claimed', (shards[shard_id],), details={'claimed_by': status['claims'][shard_id]}))
+    return [results.get(shard['shard_id'], JobResult(shard['shard_id'], 'skipped', (shard,))) for shard in selected]
+
+
+def main(args=None):
+    """
+    Command-line entry point:
+
+        python main.py plan INPUT_DIR OUTPUT_DIR [--segment soma] [--start 0] [--stop N] [--shard-size N]
+        python main.py run-shard MANIFEST [SHARD_ID ...] [--max-workers N]
+        python main.py status MANIFEST
+        python main.py merge MANIFEST
+
+    `plan` writes the shard manifest (`OUTPUT_DIR/shards.json` by default), `run-shard` processes the given shards
+    (all incomplete shards by default) on this node, `status` reports completed, missing and duplicate shards, and
+    `merge` stitches the shard outputs into the partitioned, soma and total current tables in `OUTPUT_DIR`.
+    """
+    parser = argparse.ArgumentParser(description='Partition the axial currents of file pairs into membrane current components.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    plan = commands.add_parser('plan', help='split the input directory into a shard manifest')
+    plan.add_argument('input_dir', help='directory of the preprocessed axial and membrane currents')
+    plan.add_argument('output_dir', help='directory of the shard outputs and the merged tables')
+    plan.add_argument('--manifest', help='path of the shard manifest (default: OUTPUT_DIR/shards.json)')
+    plan.add_argument('--segment', default='soma', help='target segment of the partitioning')
+    plan.add_argument('--start', type=int, default=0, help='first timepoint')
+    plan.add_argument('--stop', type=int, help='timepoint after the last one (default: all timepoints)')
+    plan.add_argument('--shard-size', type=int, help='maximum timepoints per shard (default: whole files)')
+    run = commands.add_parser('run-shard', help='process shards of a manifest on this node')
+    run.add_argument('manifest', help='path of the shard manifest')
+    run.add_argument('shard_ids', nargs='*', help='shards to process (default: all incomplete shards)')
+    run.add_argument('--max-workers', type=int, default=1, help='maximum number of shards processed in parallel')
+    status = commands.add_parser('status', help='report completed, missing and duplicate shards')
+    status.add_argument('manifest', help='path of the shard manifest')
+    merge = commands.add_parser('merge', help='stitch the shard outputs into the final tables')
+    merge.add_argument('manifest', help='path of the shard manifest')
+    args = parser.parse_args(args)
 
-    # Save partitioned currents
-    im_pos_output_path = os.path.join(partitioned_dir, f"im_part_pos_{im_number}.csv")
-    im_neg_output_path = os.path.join(partitioned_dir, f"im_part_neg_{im_number}.csv")
-    im_part_pos.to_csv(im_pos_output_path, index=True)
-    im_part_neg.to_csv(im_neg_output_path, index=True)
-
-    # Process soma currents
-    soma_pos, soma_neg = get_soma_currents_dataframes(df_im, df_iax)
-    soma_pos_path = os.path.join(soma_dir, f"soma_pos_{im_number}.csv")
-    soma_neg_path = os.path.join(soma_dir, f"soma_neg_{im_number}.csv")
-    soma_pos.to_csv(soma_pos_path, index=True)
-    soma_neg.to_csv(soma_neg_path, index=True)
-
-    # Calculate itotal
-    itotal_pos, itotal_neg = get_itotal_dataframes(df_im)
-    itotal_pos_path = os.path.join(itotal_dir, f"itotal_pos_{im_number}.csv")
-    itotal_neg_path = os.path.join(itotal_dir, f"itotal_neg_{im_number}.csv")
-    itotal_pos.to_csv(itotal_pos_path, index=True)
-    itotal_neg.to_csv(itotal_neg_path, index=True)
-
-
-def process_in_batches(batch_size=1):
-    """Process files in batches to avoid overloading system resources."""
-    # Split the file pairs into smaller batches
-    batches = [list(zip(im_values_files[i:i + batch_size], iax_values_files[i:i + batch_size]))
-               for i in range(0, len(im_values_files), batch_size)]
-
-    # Iterate over each batch and process it
-    for batch in batches:
-        with ProcessPoolExecutor(max_workers=5) as executor:
-            futures = [executor.submit(process_file_pair, im_file, iax_file) for im_file, iax_file in batch]
-            for future in futures:
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error processing files: {e}")
+    if args.command == 'plan':
+        manifest = create_shard_manifest(args.input_dir, args.output_dir, args.segment, args.start, args.stop, args.shard_size)
+        manifest_path = args.manifest or os.path.join(args.output_dir, 'shards.json')
+        write_json(manifest, manifest_path)
+        print(json.dumps({'manifest': manifest_path, 'shards': len(manifest['shards']), 'unpaired': manifest['unpaired']}))
+    elif args.command == 'run-shard':
+        for result in run_shards(args.manifest, args.shard_ids, args.max_workers):
+            print(json.dumps(asdict(result)))
+    elif args.command == 'status':
+        print(json.dumps(check_shards(read_json(args.manifest))))
+    else:
+        for result in merge_shards(read_json(args.manifest), output_format):
+            print(json.dumps(result))
 
 
 if __name__ == '__main__':
-    process_in_batches(batch_size=batch_size)
+    main()
@@ -0,0 +1,176 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+INDEX_FILE = 'index.json'
+
+
+class NpyChunkWriter:
+    """
+    Writes a table as appendable binary chunks: one .npy file per appended block of columns (timepoints) in the
+    directory `path`, together with an `index.json` sidecar holding the row index and the columns of every chunk.
+
+    The sidecar is replaced atomically after every chunk, so readers only ever see complete chunks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.metadata = None
+
+    def append(self, df: DataFrame) -> None:
+        """
+        Appends the columns of a DataFrame as a new chunk.
+
+        Parameters:
+            df (DataFrame): The block of columns to append. Its row index must match the previous chunks.
+        """
+        if self.metadata is None:
+            self._clear()
+            self.metadata = {'index': index_to_json(df.index), 'dtype': str(df.to_numpy().dtype), 'chunks': []}
+        elif index_to_json(df.index) != self.metadata['index']:
+            raise ValueError(f"The row index of the appended chunk does not match the table at {self.path}")
+
+        chunk_file = f"chunk_{len(self.metadata['chunks']):05d}.npy"
+        np.save(os.path.join(self.path, chunk_file), df.to_numpy().astype(self.metadata['dtype']))
+        self.metadata['chunks'].append({'file': chunk_file, 'columns': df.columns.tolist()})
+        self._write_metadata()
+
+    def close(self) -> None:
+        """Closes the table. A table without any appended chunk is written with no columns."""
+        if self.metadata is None:
+            self._clear()
+            self.metadata = {'index': index_to_json(pd.Index([])), 'dtype': 'float64', 'chunks': []}
+            self._write_metadata()
+
+    def _clear(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        for fname in os.listdir(self.path):
+            if fname == INDEX_FILE or (fname.startswith('chunk_') and fname.endswith('.npy')):
+                os.remove(os.path.join(self.path, fname))
+
+    def _write_metadata(self) -> None:
+        tmp_path = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvWriter:
+    """
+    Writes a table as a text CSV file (`path` + '.csv'). The appended blocks of columns are kept in memory and
+    written at once when the writer is closed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path + '.csv'
+        self.chunks = []
+
+    def append(self, df: DataFrame) -> None:
+        """Appends the columns of a DataFrame."""
+        self.chunks.append(df)
+
+    def close(self) -> None:
+        """Writes the CSV file."""
+        df = pd.concat(self.chunks, axis=1) if self.chunks else pd.DataFrame()
+        df.to_csv(self.path, index=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_output_writer(path: str, output_format: str = 'npy'):
+    """
+    Creates a writer for a table of partitioned, soma or total currents.
+
+    Parameters:
+        path (str): The output path without file extension.
+        output_format (str): The output format. Options are:
+                             - "npy": Appendable binary chunks, see `NpyChunkWriter`.
+                             - "csv": Text CSV file, see `CsvWriter`.
+
+    Returns:
+        NpyChunkWriter | CsvWriter: The writer, with `append(df)` and `close()` methods.
+    """
+    output_writers = {
+        'npy': NpyChunkWriter,
+        'csv': CsvWriter
+    }
+    return output_writers[output_format](path)
+
+
+def read_output(path: str, mmap_mode: str = None) -> DataFrame:
+    """
+    Reads a table written by `get_output_writer`, in either format.
+
+    Parameters:
+        path (str): The output path without file extension.
+        mmap_mode (str, optional): Passed to `np.load` for the binary chunks (e.g. 'r').
+
+    Returns:
+        DataFrame: The table with all chunks concatenated along the columns.
+    """
+    if not os.path.isdir(path) and os.path.exists(path + '.csv'):
+        return read_csv_output(path + '.csv')
+
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        metadata = json.load(f)
+    index = index_from_json(metadata['index'])
+    chunks = [np.load(os.path.join(path, chunk['file']), mmap_mode=mmap_mode) for chunk in metadata['chunks']]
+    # A single chunk is used as loaded (memory-mapped with `mmap_mode`), several are concatenated in memory
+    values = (chunks[0] if len(chunks) == 1 else np.concatenate(chunks, axis=1)) if chunks else np.empty((len(index), 0), dtype=metadata['dtype'])
+    columns = [column for chunk in metadata['chunks'] for column in chunk['columns']]
+    return DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def read_csv_output(path: str) -> DataFrame:
+    """Reads a CSV file written by `CsvWriter`, restoring the integer timepoints of the header."""
+    df = pd.read_csv(path, index_col=0)
+    df.columns = [int(column) if column.lstrip('-').isdigit() else column for column in df.columns]
+    return df
+
+
+def iter_output(path: str, mmap_mode: str = None):
+    """
+    Reads a table written by `get_output_writer` chunk by chunk (a CSV file is a single chunk).
+
+    Parameters:
+        path (str): The output path without file extension.
+        mmap_mode (str, optional): Passed to `np.load` for the binary chunks (e.g. 'r').
+
+    Yields:
+        DataFrame: The appended blocks of columns, in order.
+    """
+    if not os.path.isdir(path) and os.path.exists(path + '.csv'):
+        yield read_csv_output(path + '.csv')
+        return
+
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        metadata = json.load(f)
+    index = index_from_json(metadata['index'])
+    for chunk in metadata['chunks']:
+        yield DataFrame(np.load(os.path.join(path, chunk['file']), mmap_mode=mmap_mode), index=index, columns=chunk['columns'], copy=False)
+
+
+def index_to_json(index: pd.Index) -> dict:
+    """Converts a (multi)index to a JSON-serializable dictionary of names and per-level values."""
+    levels = [index.get_level_values(i) for i in range(index.nlevels)]
+    return {'names': list(index.names), 'values': [level.tolist() for level in levels]}
+
+
+def index_from_json(index_json: dict) -> pd.Index:
+    """Restores a (multi)index converted with `index_to_json`."""
+    if len(index_json['names']) > 1:
+        return pd.MultiIndex.from_arrays(index_json['values'], names=index_json['names'])
+    return pd.Index(index_json['values'][0], name=index_json['names'][0])
@@ -0,0 +1,196 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from pandas import DataFrame
+
+from partitioning_algorithm import partition_iax, encode_im
+from partitioning_order import PartitioningOrderCache, create_segment_tree, root_segment_tree
+from utils import load_df_mmap
+
+# Engines accepting a shared `order_cache`
+ORDER_CACHE_ENGINES = ('array', 'batched', 'compact')
+
+
+class Partitioner:
+    """
+    Partitions the axial currents of one im/iax file pair lazily, for the timepoints that are queried.
+
+    The values are memory-mapped, so a query only reads the columns it needs, and the tree is rooted at the target
+    once for all queries. Partitioned timepoints are kept in memory (least recently used first evicted beyond
+    `max_memory` bytes) and, with a `cache_dir`, written to disk, so repeated or overlapping queries (also in later
+    sessions) only partition the timepoints that were never computed.
+
+    Example:
+        partitioner = Partitioner(im_index_file, im_file, iax_index_file, iax_file, cache_dir='partition_cache')
+        im_part_pos, im_part_neg = partitioner.get_range(1000, 1400)
+    """
+
+    def __init__(self, im_index_file: str, im_file: str, iax_index_file: str, iax_file: str, target: str = 'soma',
+                 engine: str = 'compact', cache_dir: str = None, max_memory: int = 256 * 1024**2, **engine_options):
+        """
+        Parameters:
+            im_index_file (str): The CSV file of the multiindex of the membrane currents.
+            im_file (str): The .npy file of the membrane currents.
+            iax_index_file (str): The CSV file of the multiindex of the axial currents.
+            iax_file (str): The .npy file of the axial currents.
+            target (str): The target node of the partitioning.
+            engine (str): The `partition_iax` engine.
+            cache_dir (str, optional): The directory of the on-disk cache. Results are only kept in memory if None.
+            max_memory (int): The maximum size in bytes of the partitioned currents kept in memory.
+            **engine_options: Additional keyword arguments passed to the engine (e.g. `block_size`).
+        """
+        self.im = load_df_mmap(im_index_file, im_file)
+        self.iax = load_df_mmap(iax_index_file, iax_file)
+        self.target = target
+        self.engine = engine
+        self.engine_options = dict(engine_options)
+        self.index = self.im.index[self.im.index.get_level_values(0) == target].droplevel(0)
+        self.max_memory = max_memory
+
+        # Partitioned (positive, negative) currents by column position, most recently used last
+        self.columns = OrderedDict()
+        self.memory = 0
+        self.hits = self.disk_hits = self.misses = 0
+
+        self.cache_dir = None
+        self.disk_index = None
+        if cache_dir is not None:
+            key = get_cache_key([im_index_file, im_file, iax_index_file, iax_file], target, engine, self.engine_options)
+            self.cache_dir = os.path.join(cache_dir, key)
+
+        if engine in ORDER_CACHE_ENGINES and self.engine_options.get('order_cache') is None:
+            rooted = root_segment_tree(create_segment_tree(self.iax, nodes=encode_im(self.im)[2]), target)
+            self.engine_options['order_cache'] = PartitioningOrderCache(rooted)
+
+    def get(self, timepoints) -> tuple[DataFrame, DataFrame]:
+        """
+        Returns the partitioned currents of the target at the given timepoints, partitioning only uncached ones.
+
+        Parameters:
+            timepoints (list): The timepoints (column labels of the currents), in the order of the result columns.
+
+        Returns:
+            tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target node.
+
+        Raises:
+            KeyError: If a timepoint is not a column of the currents.
+        """
+        timepoints = list(timepoints)
+        positions = self.im.columns.get_indexer(timepoints)
+        if (positions < 0).any():
+            raise KeyError(f"Timepoints not in the data: {[tp for tp, position in zip(timepoints, positions) if position < 0]}")
+
+        found = {}
+        for position in dict.fromkeys(positions.tolist()):
+            if position in self.columns:
+                self.columns.move_to_end(position)
+                found[position] = self.columns[position]
+                self.hits += 1
+
+        loaded = {}
+        missing = [position for position in dict.fromkeys(positions.tolist()) if position not in found]
+        if missing and self.cache_dir is not None:
+            loaded.update(self._read_disk(missing))
+            self.disk_hits += len(loaded)
+            missing = [position for position in missing if position not in loaded]
+        if missing:
+            computed = self._partition(missing)
+            self.misses += len(missing)
+            if self.cache_dir is not None:
+                self._write_disk(missing, computed)
+            loaded.update(computed)
+
+        found.update(loaded)
+        for position, values in loaded.items():
+            self._remember(position, values)
+
+        columns = self.im.columns[positions]
+        n_rows = len(self.index)
+        part_pos = np.column_stack([found[position][0] for position in positions]) if len(positions) else np.empty((n_rows, 0))
+        part_neg = np.column_stack([found[position][1] for position in positions]) if len(positions) else np.empty((n_rows, 0))
+        return DataFrame(part_pos, index=self.index, columns=columns), DataFrame(part_neg, index=self.index, columns=columns)
+
+    def get_range(self, start, stop) -> tuple[DataFrame, DataFrame]:
+        """Returns the partitioned currents of the timepoints `start <= timepoint < stop`, see `get`."""
+        return self.get(self.im.columns[(self.im.columns >= start) & (self.im.columns < stop)])
+
+    def cache_info(self) -> dict:
+        """Returns the numbers of timepoints served from memory, from disk and partitioned, and the memory in use."""
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'columns': len(self.columns),
+                'memory': self.memory, 'max_memory': self.max_memory}
+
+    def clear(self) -> None:
+        """Empties the in-memory cache (the on-disk cache is kept)."""
+        self.columns.clear()
+        self.memory = 0
+
+    def _partition(self, positions: list) -> dict:
+        timepoints = self.im.columns[sorted(positions)]
+        part_pos, part_neg = partition_iax(self.im, self.iax, list(timepoints), self.target, engine=self.engine, **self.engine_options)
+        part_pos, part_neg = part_pos.to_numpy(), part_neg.to_numpy()
+        return {position: (part_pos[:, i].copy(), part_neg[:, i].copy()) for i, position in enumerate(sorted(positions))}
+
+    def _remember(self, position: int, values: tuple) -> None:
+        self.columns[position] = values
+        self.memory += values[0].nbytes + values[1].nbytes
+        while self.memory > self.max_memory and self.columns:
+            evicted = self.columns.popitem(last=False)[1]
+            self.memory -= evicted[0].nbytes + evicted[1].nbytes
+
+    def _read_disk(self, positions: list) -> dict:
+        if self.disk_index is None:
+            self.disk_index = {}
+            if os.path.isdir(self.cache_dir):
+                for fname in sorted(os.listdir(self.cache_dir)):
+                    if fname.startswith('chunk_') and fname.endswith('.npz'):
+                        with np.load(os.path.join(self.cache_dir, fname)) as chunk:
+                            self.disk_index.update(dict.fromkeys(chunk['positions'].tolist(), fname))
+
+        by_file = {}
+        for position in positions:
+            if position in self.disk_index:
+                by_file.setdefault(self.disk_index[position], []).append(position)
+        loaded = {}
+        for fname, file_positions in by_file.items():
+            with np.load(os.path.join(self.cache_dir, fname)) as chunk:
+                columns = dict(zip(chunk['positions'].tolist(), range(len(chunk['positions']))))
+                part_pos, part_neg = chunk['part_pos'], chunk['part_neg']
+            for position in file_positions:
+                loaded[position] = (part_pos[:, columns[position]].copy(), part_neg[:, columns[position]].copy())
+        return loaded
+
+    def _write_disk(self, positions: list, computed: dict) -> None:
+        positions = sorted(positions)
+        digest = hashlib.blake2b(np.asarray(positions, dtype=np.int64).tobytes(), digest_size=8).hexdigest()
+        fname = f'chunk_{positions[0]:08d}_{positions[-1]:08d}_{digest}.npz'
+        # Write to a temporary file first, so concurrent sessions never read a partial chunk
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False) as tmp:
+            np.savez(tmp, positions=np.asarray(positions, dtype=np.int64),
+                     part_pos=np.column_stack([computed[position][0] for position in positions]),
+                     part_neg=np.column_stack([computed[position][1] for position in positions]))
+        os.replace(tmp.name, os.path.join(self.cache_dir, fname))
+        if self.disk_index is not None:
+            self.disk_index.update(dict.fromkeys(positions, fname))
+
+
+def get_cache_key(files: list[str], target: str, engine: str, engine_options: dict) -> str:
+    """
+    Identifies the partitioned currents of a file pair in the on-disk cache of `Partitioner`.
+
+    The key changes whenever one of the files changes (by size or modification time) or the target, the engine or
+    its options differ.
+
+    Returns:
+        str: The hexadecimal key.
+    """
+    parts = []
+    for fname in files:
+        stat = os.stat(fname)
+        parts.append(f'{os.path.abspath(fname)}:{stat.st_size}:{stat.st_mtime_ns}')
+    options = sorted((name, repr(value)) for name, value in engine_options.items() if name != 'order_cache')
+    parts += [target, engine, repr(options)]
+    return hashlib.blake2b('\n'.join(parts).encode(), digest_size=16).hexdigest()
@@ -1,12 +1,17 @@
+import os
+from dataclasses import dataclass
+
 import pandas as pd
 import numpy as np
 from pandas import DataFrame, Series
 from tqdm import tqdm
 
-from partitioning_order import create_directed_graph, get_partitioning_order
+from instrumentation import stage
+from shared_arrays import share_array, attach_array
+from partitioning_order import create_directed_graph, get_partitioning_order, create_segment_tree, root_segment_tree, PartitioningOrderCache, RootedTree, group_timepoints_by_sign
 
 
-def partition_iax(im: DataFrame, iax: DataFrame, timepoints: list, target: str) -> tuple[DataFrame, DataFrame]:
+def partition_iax(im: DataFrame, iax: DataFrame, timepoints: list, target: str, engine: str = "pandas", **engine_options) -> tuple[DataFrame, DataFrame]:
     """
     Partitions axial currents into membrane currents across multiple time points and updates a copy of the membrane currents DataFrame.
 
@@ -15,28 +20,62 @@ def partition_iax(im: DataFrame, iax: DataFrame, timepoints: list, target: str)
         iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
         timepoints (list): A list of time points for which the partitioning process is performed.
         target (str): The target node to start the partitioning traversal from.
+        engine (str): The partitioning engine. Options are:
+                      - "pandas": Reference implementation updating `im` with DataFrame `.loc` lookups.
+                      - "array": Dense (segment, itype) NumPy arrays with integer segment codes.
+                      - "batched": Like "array", sweeping all time points with the same sign pattern of `iax` at once.
+                      - "compact": Like "batched", storing only the itypes of every segment in contiguous rows, see `CompactLayout`.
+                      - "parallel": Splits the time points across worker processes sharing the values, see `TimepointPool`.
+        **engine_options: Additional keyword arguments passed to the engine (e.g. `order_cache` or `block_size`).
 
     Returns:
         tuple[DataFrame, DataFrame]: A modified copy of `im` with updated membrane currents after partitioning axial currents for all time points. Positive and negative currents are in separate dataframes.
     """
+    partitioning_engines = {
+        "pandas": partition_iax_pandas,
+        "array": partition_iax_array,
+        "batched": partition_iax_batched,
+        "compact": partition_iax_compact,
+        "parallel": partition_iax_parallel
+    }
+    return partitioning_engines[engine](im, iax, timepoints, target, **engine_options)
+
+
+def partition_iax_pandas(im: DataFrame, iax: DataFrame, timepoints: list, target: str) -> tuple[DataFrame, DataFrame]:
+    """
+    Reference implementation of `partition_iax`, updating the membrane currents with DataFrame `.loc` lookups for every segment pair.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        timepoints (list): A list of time points for which the partitioning process is performed.
+        target (str): The target node to start the partitioning traversal from.
+
+    Returns:
+        tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target node.
+    """
     # Separate DataFrames for positive and negative membrane currents
     im_pos = im.clip(lower=0)  # Positive currents only
     im_neg = im.clip(upper=0)  # Negative currents only
 
     for tp in tqdm(timepoints):
-        dg = create_directed_graph(iax, tp)
+        with stage('graph'):
+            dg = create_directed_graph(iax, tp)
 
-        partitioning_order_out = get_partitioning_order(dg, target, 'out')
-        for segment_pair in partitioning_order_out:
-            ref = segment_pair[0]
-            par = segment_pair[1]
-            partition_iax_single(ref, par, tp, im_pos, iax)
+        with stage('traversal'):
+            partitioning_order_out = get_partitioning_order(dg, target, 'out')
+            partitioning_order_in = get_partitioning_order(dg, target, 'in')
 
-        partitioning_order_in = get_partitioning_order(dg, target, 'in')
-        for segment_pair in partitioning_order_in:
-            ref = segment_pair[0]
-            par = segment_pair[1]
-            partition_iax_single(ref, par, tp, im_neg, iax)
+        with stage('partitioning'):
+            for segment_pair in partitioning_order_out:
+                ref = segment_pair[0]
+                par = segment_pair[1]
+                partition_iax_single(ref, par, tp, im_pos, iax)
+
+            for segment_pair in partitioning_order_in:
+                ref = segment_pair[0]
+                par = segment_pair[1]
+                partition_iax_single(ref, par, tp, im_neg, iax)
 
     return im_pos.iloc[:, timepoints].loc[target], im_neg.iloc[:, timepoints].loc[target]
 
@@ -106,6 +145,781 @@ def get_part_in(iax_tp: float, im_tp_in: Series) -> Series:
     return partitioned_in
 
 
+def encode_im(im: DataFrame) -> tuple[np.ndarray, np.ndarray, pd.Index, pd.Index]:
+    """
+    Encodes the (segment, itype) multiindex of the membrane currents as integer codes.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents indexed by segment and itype.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, pd.Index, pd.Index]: The segment code and itype code of every row,
+        followed by the segment names and itype names the codes refer to.
+    """
+    segment_codes, segments = pd.factorize(im.index.get_level_values(0))
+    itype_codes, itypes = pd.factorize(im.index.get_level_values(1))
+    return segment_codes, itype_codes, pd.Index(segments), pd.Index(itypes)
+
+
+def get_present_mask(segment_codes: np.ndarray, itype_codes: np.ndarray, segments: pd.Index, itypes: pd.Index) -> np.ndarray:
+    """
+    Marks the itypes present in each segment of the membrane currents.
+
+    Parameters:
+        See the return value of `encode_im`.
+
+    Returns:
+        np.ndarray: A boolean (segment, itype) mask of the itypes present in each segment.
+    """
+    present = np.zeros((len(segments), len(itypes)), dtype=bool)
+    present[segment_codes, itype_codes] = True
+    return present
+
+
+def get_edge_sign(rooted: RootedTree) -> np.ndarray:
+    """
+    Returns the sign turning the axial current of every tree edge into the current from the perspective of its
+    child node (axial currents are stored from the perspective of the reference node).
+    """
+    return np.where(rooted.child_is_ref, 1, -1)
+
+
+def get_timepoint_blocks(iax_values: np.ndarray, columns: np.ndarray, block_size: int) -> list[np.ndarray]:
+    """
+    Splits time points into blocks sharing the sign pattern of the axial currents, see `group_timepoints_by_sign`.
+
+    Parameters:
+        iax_values (np.ndarray): The (edge, time point) axial currents.
+        columns (np.ndarray): The columns of `iax_values` of the time points.
+        block_size (int): The maximum number of time points in a block.
+
+    Returns:
+        list[np.ndarray]: The positions in `columns` of the time points of every block.
+    """
+    return [group[start:start + block_size]
+            for group in group_timepoints_by_sign(iax_values[:, columns])
+            for start in range(0, len(group), block_size)]
+
+
+def get_order_cache(order_cache: PartitioningOrderCache, iax: DataFrame, segments: pd.Index, target: str) -> PartitioningOrderCache:
+    """
+    Returns the cache of partitioning orders of an engine, creating it if none is passed.
+
+    Parameters:
+        order_cache (PartitioningOrderCache): The cache passed to the engine, or None.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        segments (pd.Index): The segment names of the membrane currents, see `encode_im`.
+        target (str): The target node of the partitioning.
+
+    Returns:
+        PartitioningOrderCache: The cache, rooted at the target with node codes matching `segments`.
+    """
+    if order_cache is None:
+        with stage('graph'):
+            return PartitioningOrderCache(root_segment_tree(create_segment_tree(iax, nodes=segments), target))
+    # A cache of another target or of other node codes would silently return the partitions of another tree
+    assert order_cache.rooted.tree.nodes.equals(segments), "The order cache was created for other segments"
+    assert order_cache.rooted.target == segments.get_loc(target), f"The order cache is not rooted at {target}"
+    return order_cache
+
+
+def partition_iax_array(im: DataFrame, iax: DataFrame, timepoints: list, target: str, order_cache: PartitioningOrderCache = None) -> tuple[DataFrame, DataFrame]:
+    """
+    Array implementation of `partition_iax`.
+
+    The membrane currents of each time point are scattered into a dense (segment, itype) array and the
+    partitioning is done with integer indexing along the array-based traversal order of the segment tree,
+    producing the same result as `partition_iax_pandas`. Time points sharing the sign pattern of the axial
+    currents reuse the partitioning orders from the order cache.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        timepoints (list): A list of time points for which the partitioning process is performed.
+        target (str): The target node to start the partitioning traversal from.
+        order_cache (PartitioningOrderCache, optional): The cache of partitioning orders, rooted at the target.
+                                                        A new cache is created if not given.
+
+    Returns:
+        tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target node.
+    """
+    segment_codes, itype_codes, segments, itypes = encode_im(im)
+    present = get_present_mask(segment_codes, itype_codes, segments, itypes)
+    order_cache = get_order_cache(order_cache, iax, segments, target)
+    rooted = order_cache.rooted
+    edge_sign = get_edge_sign(rooted)
+
+    im_values = im.to_numpy()
+    iax_values = iax.to_numpy()
+    target_rows = np.flatnonzero(segment_codes == rooted.target)
+    part_pos = np.empty((len(target_rows), len(timepoints)), dtype=im_values.dtype)
+    part_neg = np.empty((len(target_rows), len(timepoints)), dtype=im_values.dtype)
+
+    for i, tp in enumerate(tqdm(timepoints)):
+        im_tp = im_values[:, im.columns.get_loc(tp)]
+        iax_tp = iax_values[:, iax.columns.get_loc(tp)]
+
+        with stage('traversal'):
+            partitioning_orders = order_cache.get_partitioning_orders(iax_tp)
+
+        with stage('partitioning'):
+            im_pos = np.zeros(present.shape, dtype=im_values.dtype)
+            im_pos[segment_codes, itype_codes] = im_tp.clip(min=0)
+            children, parents, edges = partitioning_orders['out']
+            for ref, par, iax_edge in zip(children.tolist(), parents.tolist(), iax_tp[edges] * edge_sign[children]):
+                partition_iax_single_array(ref, par, iax_edge, im_pos, present)
+
+            im_neg = np.zeros(present.shape, dtype=im_values.dtype)
+            im_neg[segment_codes, itype_codes] = im_tp.clip(max=0)
+            children, parents, edges = partitioning_orders['in']
+            for ref, par, iax_edge in zip(children.tolist(), parents.tolist(), iax_tp[edges] * edge_sign[children]):
+                partition_iax_single_array(ref, par, iax_edge, im_neg, present)
+
+        part_pos[:, i] = im_pos[rooted.target, itype_codes[target_rows]]
+        part_neg[:, i] = im_neg[rooted.target, itype_codes[target_rows]]
+
+    index = im.index[target_rows].droplevel(0)
+    columns = im.columns[im.columns.get_indexer(timepoints)]
+    return DataFrame(part_pos, index=index, columns=columns), DataFrame(part_neg, index=index, columns=columns)
+
+
+def partition_iax_single_array(ref: int, par: int, iax_tp: float, im: np.ndarray, present: np.ndarray) -> None:
+    """
+    Array counterpart of `partition_iax_single`, operating on a dense (segment, itype) array of a single time point.
+
+    Parameters:
+        ref (int): The segment code of the reference node (child node).
+        par (int): The segment code of the parent node.
+        iax_tp (float): The axial current between the reference and the parent node.
+        im (np.ndarray): A dense (segment, itype) array of membrane currents, updated in place.
+        present (np.ndarray): A boolean (segment, itype) mask of the itypes present in each segment.
+
+    Returns:
+        None: The function adds the partitioned axial current to the parent row of `im` in place.
+    """
+    im_ref = im[ref]
+    # Outward currents take part in a positive, inward currents in a negative axial current (`get_part_out`/`get_part_in`)
+    taking_part = present[ref] & (im_ref >= 0 if iax_tp >= 0 else im_ref < 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = im_ref / np.where(taking_part, im_ref, 0).sum()
+
+    # Components without a matching itype in the parent are dropped (as `reindex` does)
+    part_curr = np.where(taking_part & present[par], ratios * iax_tp, 0)
+    im[par] = (im[par] + part_curr).astype(np.float32)
+
+
+def partition_iax_batched(im: DataFrame, iax: DataFrame, timepoints: list, target: str, block_size: int = 256, order_cache: PartitioningOrderCache = None) -> tuple[DataFrame, DataFrame]:
+    """
+    Batched implementation of `partition_iax`, sweeping blocks of time points at once.
+
+    Time points sharing the sign pattern of the axial currents share their partitioning orders, so the
+    leaf-to-target sweep is done once per group on a (segment, time point, itype) slab of membrane currents.
+    The itype axis is kept innermost, so the per-segment sums are the same as in `partition_iax_array`.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        timepoints (list): A list of time points for which the partitioning process is performed.
+        target (str): The target node to start the partitioning traversal from.
+        block_size (int): The maximum number of time points in a slab, bounding its memory use.
+        order_cache (PartitioningOrderCache, optional): The cache of partitioning orders, rooted at the target.
+                                                        A new cache is created if not given.
+
+    Returns:
+        tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target node.
+    """
+    segment_codes, itype_codes, segments, itypes = encode_im(im)
+    present = get_present_mask(segment_codes, itype_codes, segments, itypes)
+    order_cache = get_order_cache(order_cache, iax, segments, target)
+    rooted = order_cache.rooted
+    edge_sign = get_edge_sign(rooted)
+
+    im_values = im.to_numpy()
+    iax_values = iax.to_numpy()
+    im_columns = im.columns.get_indexer(timepoints)
+    iax_columns = iax.columns.get_indexer(timepoints)
+    target_rows = np.flatnonzero(segment_codes == rooted.target)
+    part_pos = np.empty((len(target_rows), len(timepoints)), dtype=im_values.dtype)
+    part_neg = np.empty((len(target_rows), len(timepoints)), dtype=im_values.dtype)
+
+    blocks = get_timepoint_blocks(iax_values, iax_columns, block_size)
+    for block in tqdm(blocks):
+        im_block = im_values[:, im_columns[block]]
+        iax_block = iax_values[:, iax_columns[block]]
+        with stage('traversal'):
+            partitioning_orders = order_cache.get_partitioning_orders(iax_block[:, 0])
+
+        with stage('partitioning'):
+            for direction, im_clipped, part in (('out', im_block.clip(min=0), part_pos), ('in', im_block.clip(max=0), part_neg)):
+                im_slab = np.zeros((len(segments), len(block), len(itypes)), dtype=im_values.dtype)
+                im_slab[segment_codes, :, itype_codes] = im_clipped
+                children, parents, edges = partitioning_orders[direction]
+                iax_edges = iax_block[edges] * edge_sign[children][:, None]
+                for ref, par, iax_edge in zip(children.tolist(), parents.tolist(), iax_edges):
+                    partition_iax_single_batched(ref, par, iax_edge, im_slab, present)
+                part[:, block] = im_slab[rooted.target, :, itype_codes[target_rows]]
+
+    index = im.index[target_rows].droplevel(0)
+    columns = im.columns[im.columns.get_indexer(timepoints)]
+    return DataFrame(part_pos, index=index, columns=columns), DataFrame(part_neg, index=index, columns=columns)
+
+
+def partition_iax_single_batched(ref: int, par: int, iax_block: np.ndarray, im: np.ndarray, present: np.ndarray) -> None:
+    """
+    Batched counterpart of `partition_iax_single_array`, operating on a (segment, time point, itype) slab.
+
+    Parameters:
+        ref (int): The segment code of the reference node (child node).
+        par (int): The segment code of the parent node.
+        iax_block (np.ndarray): The axial current between the reference and the parent node at every time point
+                                of the slab. All values must have the same sign.
+        im (np.ndarray): A (segment, time point, itype) slab of membrane currents, updated in place.
+        present (np.ndarray): A boolean (segment, itype) mask of the itypes present in each segment.
+
+    Returns:
+        None: The function adds the partitioned axial current to the parent rows of `im` in place.
+    """
+    im_ref = im[ref]
+    taking_part = present[ref] & (im_ref >= 0 if iax_block[0] >= 0 else im_ref < 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = im_ref / np.where(taking_part, im_ref, 0).sum(axis=1, keepdims=True)
+
+    part_curr = np.where(taking_part & present[par], ratios * iax_block[:, None], 0)
+    im[par] = (im[par] + part_curr).astype(np.float32)
+
+
+@dataclass(frozen=True)
+class CompactLayout:
+    """
+    Compact storage of the membrane currents, with the rows of every segment stored contiguously.
+
+    The (segment, itype) rows of `im` are sorted by segment (keeping their order within a segment), so the itypes of
+    segment `s` are the compact rows `indptr[s]:indptr[s + 1]`. Unlike the dense (segment, itype) arrays of the
+    "array" and "batched" engines, segments only store the itypes they carry.
+
+    Attributes:
+        itypes (pd.Index): The itype vocabulary.
+        order (np.ndarray): The row of `im` stored in every compact row.
+        rows (np.ndarray): The compact row of every row of `im` (the inverse of `order`).
+        indptr (np.ndarray): The first compact row of every segment, followed by the number of rows.
+        itype_codes (np.ndarray): The itype code of every compact row.
+    """
+    itypes: pd.Index
+    order: np.ndarray
+    rows: np.ndarray
+    indptr: np.ndarray
+    itype_codes: np.ndarray
+
+
+def create_compact_layout(im: DataFrame) -> CompactLayout:
+    """
+    Creates the compact layout of the membrane currents.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents indexed by segment and itype.
+
+    Returns:
+        CompactLayout: The segment-sorted order of the rows with the row range of every segment.
+    """
+    segment_codes, itype_codes, segments, itypes = encode_im(im)
+    order = np.argsort(segment_codes, kind='stable')
+    rows = np.empty_like(order)
+    rows[order] = np.arange(len(order))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(segment_codes, minlength=len(segments)))])
+    return CompactLayout(itypes, order, rows, indptr, itype_codes[order])
+
+
+def get_parent_rows(layout: CompactLayout, parent: np.ndarray) -> np.ndarray:
+    """
+    Maps every compact row to the row of the same itype in the parent segment.
+
+    Parameters:
+        layout (CompactLayout): The compact layout of the membrane currents.
+        parent (np.ndarray): The parent segment code of every segment (-1 for the root), see `RootedTree`.
+
+    Returns:
+        np.ndarray: The parent row of every compact row, -1 for the root and for itypes the parent does not have
+        (their partitioned currents are dropped, as `reindex` does in `partition_iax_single`).
+    """
+    n_segments = len(layout.indptr) - 1
+    segment_of_row = np.repeat(np.arange(n_segments), np.diff(layout.indptr))
+    # The extra last row (index -1, the parent of the root) stays -1
+    row_of = np.full((n_segments + 1, len(layout.itypes)), -1, dtype=np.intp)
+    row_of[segment_of_row, layout.itype_codes] = np.arange(len(layout.itype_codes))
+    return row_of[parent[segment_of_row], layout.itype_codes]
+
+
+def partition_iax_compact(im: DataFrame, iax: DataFrame, timepoints: list, target: str, block_size: int = 256, dtype=None, order_cache: PartitioningOrderCache = None) -> tuple[DataFrame, DataFrame]:
+    """
+    Compact implementation of `partition_iax`, sweeping blocks of time points like `partition_iax_batched` on
+    (compact row, time point) slabs in the `CompactLayout` of the membrane currents. Every partitioning step works
+    on the contiguous rows of the child and the parent segment.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        timepoints (list): A list of time points for which the partitioning process is performed.
+        target (str): The target node to start the partitioning traversal from.
+        block_size (int): The maximum number of time points in a slab, bounding its memory use.
+        dtype (optional): The dtype of the slabs. Defaults to the dtype of `im`; `np.float32` halves the memory of
+                          float64 currents (the partitioned currents are rounded to float32 anyway).
+        order_cache (PartitioningOrderCache, optional): The cache of partitioning orders, rooted at the target.
+                                                        A new cache is created if not given.
+
+    Returns:
+        tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target node.
+    """
+    layout = create_compact_layout(im)
+    order_cache = get_order_cache(order_cache, iax, encode_im(im)[2], target)
+    rooted = order_cache.rooted
+    parent_rows = get_parent_rows(layout, rooted.parent)
+    # Rows of `im` already grouped by segment are used without reordering
+    sorted_rows = np.array_equal(layout.order, np.arange(len(layout.order)))
+    edge_sign = get_edge_sign(rooted)
+
+    im_values = im.to_numpy()
+    iax_values = iax.to_numpy()
+    dtype = np.dtype(dtype or im_values.dtype)
+    im_columns = im.columns.get_indexer(timepoints)
+    iax_columns = iax.columns.get_indexer(timepoints)
+    target_rows = np.arange(layout.indptr[rooted.target], layout.indptr[rooted.target + 1])
+    part_pos = np.empty((len(target_rows), len(timepoints)), dtype=dtype)
+    part_neg = np.empty((len(target_rows), len(timepoints)), dtype=dtype)
+
+    blocks = get_timepoint_blocks(iax_values, iax_columns, block_size)
+    for block in tqdm(blocks):
+        # Only the columns of the block are gathered, also when the rows are reordered
+        im_block = im_values[:, im_columns[block]] if sorted_rows else im_values[np.ix_(layout.order, im_columns[block])]
+        iax_block = iax_values[:, iax_columns[block]]
+        with stage('traversal'):
+            partitioning_orders = order_cache.get_partitioning_orders(iax_block[:, 0])
+
+        with stage('partitioning'):
+            for direction, im_slab, part in (('out', im_block.clip(min=0).astype(dtype, copy=False), part_pos), ('in', im_block.clip(max=0).astype(dtype, copy=False), part_neg)):
+                children, parents, edges = partitioning_orders[direction]
+                iax_edges = iax_block[edges] * edge_sign[children][:, None]
+                for ref, par, iax_edge in zip(children.tolist(), parents.tolist(), iax_edges):
+                    partition_iax_single_compact(ref, par, iax_edge, im_slab, layout.indptr, parent_rows)
+                part[:, block] = im_slab[target_rows]
+
+    index = im.index[layout.order[target_rows]].droplevel(0)
+    columns = im.columns[im.columns.get_indexer(timepoints)]
+    return DataFrame(part_pos, index=index, columns=columns), DataFrame(part_neg, index=index, columns=columns)
+
+
+def partition_iax_single_compact(ref: int, par: int, iax_block: np.ndarray, im: np.ndarray, indptr: np.ndarray, parent_rows: np.ndarray) -> None:
+    """
+    Compact counterpart of `partition_iax_single_batched`, operating on a (compact row, time point) slab.
+
+    Parameters:
+        ref (int): The segment code of the reference node (child node).
+        par (int): The segment code of the parent node.
+        iax_block (np.ndarray): The axial current between the reference and the parent node at every time point
+                                of the slab. All values must have the same sign.
+        im (np.ndarray): A (compact row, time point) slab of membrane currents, updated in place.
+        indptr (np.ndarray): The compact rows of every segment, see `CompactLayout`.
+        parent_rows (np.ndarray): The row of the same itype in the parent segment, see `get_parent_rows`.
+
+    Returns:
+        None: The function adds the partitioned axial current to the parent rows of `im` in place.
+    """
+    ref_start, ref_end = indptr[ref], indptr[ref + 1]
+    par_start, par_end = indptr[par], indptr[par + 1]
+    im_ref = im[ref_start:ref_end]
+    taking_part = im_ref >= 0 if iax_block[0] >= 0 else im_ref < 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratios = im_ref / np.where(taking_part, im_ref, 0).sum(axis=0)
+
+    # Components without a matching itype in the parent are dropped (as `reindex` does)
+    matched = parent_rows[ref_start:ref_end] >= 0
+    im_par = im[par_start:par_end].copy()
+    im_par[parent_rows[ref_start:ref_end][matched] - par_start] += np.where(taking_part[matched], ratios[matched] * iax_block, 0)
+    im[par_start:par_end] = im_par.astype(np.float32)
+
+
+def partition_iax_multi(im: DataFrame, iax: DataFrame, timepoints: list, targets: list = None, block_size: int = 256) -> tuple[DataFrame, DataFrame]:
+    """
+    Partitions axial currents into membrane currents for several target nodes in a single pass.
+
+    The tree is rooted once and every block of time points sharing a sign pattern is swept twice. The
+    leaf-to-root sweep accumulates, for every segment, the currents partitioned from its own subtree. The
+    root-to-leaf sweep then adds the currents partitioned from the rest of the tree, which only reach a segment
+    through the edge to its parent if that edge points against the leaf-to-root sweep. The result for every
+    segment matches `partition_iax` with that segment as target, to float32 precision.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        timepoints (list): A list of time points for which the partitioning process is performed.
+        targets (list, optional): The target nodes. Defaults to all segments of `im`.
+        block_size (int): The maximum number of time points in a slab, bounding its memory use.
+
+    Returns:
+        tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target nodes,
+        indexed like `im` by segment and itype.
+    """
+    segment_codes, itype_codes, segments, itypes = encode_im(im)
+    present = get_present_mask(segment_codes, itype_codes, segments, itypes)
+    if targets is None:
+        targets = list(segments)
+    with stage('graph'):
+        rooted = root_segment_tree(create_segment_tree(iax, nodes=segments), targets[0])
+    nodes = rooted.preorder['out'][1:]
+    node_depth = rooted.depth[nodes]
+    edge_sign = get_edge_sign(rooted)[nodes][:, None]
+
+    im_values = im.to_numpy()
+    iax_values = iax.to_numpy()
+    im_columns = im.columns.get_indexer(timepoints)
+    iax_columns = iax.columns.get_indexer(timepoints)
+    target_rows = np.flatnonzero(np.isin(segment_codes, segments.get_indexer(targets)))
+    part_pos = np.empty((len(target_rows), len(timepoints)))
+    part_neg = np.empty((len(target_rows), len(timepoints)))
+
+    blocks = get_timepoint_blocks(iax_values, iax_columns, block_size)
+    for block in tqdm(blocks):
+        im_block = im_values[:, im_columns[block]].astype(np.float64)
+        iax_edges = iax_values[rooted.parent_edge[nodes]][:, iax_columns[block]] * edge_sign
+        # Same orientation test as in `get_partitioning_order_codes`, edges with NaN axial currents are left out
+        iax_first = iax_values[rooted.parent_edge[nodes], iax_columns[block[0]]]
+        points_out = (iax_first >= 0) == rooted.child_is_ref[nodes]
+        connected = ~np.isnan(iax_first)
+
+        with stage('partitioning'):
+            for direction, im_clipped, part in (('out', im_block.clip(min=0), part_pos), ('in', im_block.clip(max=0), part_neg)):
+                outward = direction == 'out'
+                im_slab = np.zeros((len(segments), len(block), len(itypes)))
+                im_slab[segment_codes, :, itype_codes] = im_clipped
+
+                # Leaf-to-root: children whose edge points away from their parent (in the traversal direction) feed the parent
+                down = (points_out == outward) & connected
+                get_partitioning_factors(rooted, nodes[down], rooted.parent[nodes[down]], iax_edges[down], im_slab, present, outward)
+                # Root-to-leaf: the remaining edges feed the child with everything its parent collected
+                for level_depth in range(1, node_depth.max(initial=0) + 1):
+                    up = ~down & connected & (node_depth == level_depth)
+                    if up.any():
+                        partition_iax_level(rooted.parent[nodes[up]], nodes[up], -iax_edges[up], im_slab, present, outward)
+
+                part[:, block] = im_slab[segment_codes[target_rows], :, itype_codes[target_rows]]
+
+    index = im.index[target_rows]
+    columns = im.columns[im.columns.get_indexer(timepoints)]
+    return DataFrame(part_pos, index=index, columns=columns), DataFrame(part_neg, index=index, columns=columns)
+
+
+def get_origin_contributions(im: DataFrame, iax: DataFrame, timepoints: list, target: str, block_size: int = 256, order_cache: PartitioningOrderCache = None) -> tuple[DataFrame, DataFrame]:
+    """
+    Computes how much every membrane current of every segment contributes to the partitioned currents of the target.
+
+    This is an analysis helper (requires `scipy`), not a faster way to partition: it runs the per-itype sweep of
+    the batched engine and solves for the path weights on top of it. Summing the contributions over the segments of
+    each itype gives the result of `partition_iax`, to float32 precision.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        timepoints (list): A list of time points for which the partitioning process is performed.
+        target (str): The target node to start the partitioning traversal from.
+        block_size (int): The maximum number of time points solved at once.
+        order_cache (PartitioningOrderCache, optional): The cache of partitioning orders, rooted at the target.
+
+    Returns:
+        tuple[DataFrame, DataFrame]: The positive and negative contributions, indexed like `im` by origin segment and itype.
+    """
+    contributions_pos = np.zeros((len(im), len(timepoints)))
+    contributions_neg = np.zeros((len(im), len(timepoints)))
+    for block, block_pos, block_neg in iterate_origin_contributions(im, iax, timepoints, target, block_size, order_cache):
+        contributions_pos[:, block] = block_pos
+        contributions_neg[:, block] = block_neg
+
+    columns = im.columns[im.columns.get_indexer(timepoints)]
+    return DataFrame(contributions_pos, index=im.index, columns=columns), DataFrame(contributions_neg, index=im.index, columns=columns)
+
+
+def iterate_origin_contributions(im: DataFrame, iax: DataFrame, timepoints: list, target: str, block_size: int = 256, order_cache: PartitioningOrderCache = None):
+    """
+    Computes the contribution of every membrane current row to the target, block by block of time points.
+
+    For a fixed orientation of the tree, the component of an origin segment reaching the target is its membrane
+    current scaled by the product of the partitioning factors (axial current / total partitioned current) along
+    its path, provided every segment along the path carries the same itype. The factors are computed with a
+    level-synchronous sweep and the products with a sparse lower-triangular solve over the tree. Contributions
+    of target components that are NaN in `partition_iax` are NaN.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+        iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+        timepoints (list): A list of time points for which the partitioning process is performed.
+        target (str): The target node to start the partitioning traversal from.
+        block_size (int): The maximum number of time points solved at once.
+        order_cache (PartitioningOrderCache, optional): The cache of partitioning orders, rooted at the target.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The positions of the block in `timepoints`, followed by the
+        positive and negative (membrane current row, time point) contributions.
+    """
+    segment_codes, itype_codes, segments, itypes = encode_im(im)
+    present = get_present_mask(segment_codes, itype_codes, segments, itypes)
+    order_cache = get_order_cache(order_cache, iax, segments, target)
+    rooted = order_cache.rooted
+    edge_sign = get_edge_sign(rooted)
+    target_rows = np.flatnonzero(segment_codes == rooted.target)
+
+    im_values = im.to_numpy()
+    iax_values = iax.to_numpy()
+    im_columns = im.columns.get_indexer(timepoints)
+    iax_columns = iax.columns.get_indexer(timepoints)
+
+    blocks = get_timepoint_blocks(iax_values, iax_columns, block_size)
+    for block in tqdm(blocks):
+        im_block = im_values[:, im_columns[block]].astype(np.float64)
+        iax_block = iax_values[:, iax_columns[block]]
+        with stage('traversal'):
+            partitioning_orders = order_cache.get_partitioning_orders(iax_block[:, 0])
+
+        contributions = []
+        with stage('partitioning'):
+            for direction, im_clipped in (('out', im_block.clip(min=0)), ('in', im_block.clip(max=0))):
+                children, parents, edges = partitioning_orders[direction]
+                iax_edges = iax_block[edges] * edge_sign[children][:, None]
+                im_slab = np.zeros((len(segments), len(block), len(itypes)))
+                im_slab[segment_codes, :, itype_codes] = im_clipped
+                factors = get_partitioning_factors(rooted, children, parents, iax_edges, im_slab, present, direction == 'out')
+                weights = get_origin_weights(rooted, children, factors)
+                reaching = get_reaching_components(rooted, present, im_slab)[segment_codes, :, itype_codes]
+                block_contributions = np.where(reaching, im_clipped * weights[segment_codes], 0)
+                # Target components that ended up NaN stay undefined, as in the other engines
+                undefined = np.isnan(im_slab[rooted.target, :, itype_codes[target_rows]])
+                block_contributions[target_rows] = np.where(undefined, np.nan, block_contributions[target_rows])
+                contributions.append(block_contributions)
+        yield block, contributions[0], contributions[1]
+
+
+def get_reaching_components(rooted: RootedTree, present: np.ndarray, im: np.ndarray) -> np.ndarray:
+    """
+    Determines which membrane current components of every segment reach the root after the partitioning sweep.
+
+    A component is dropped if a segment on its path does not carry the same itype (as `reindex` does in
+    `partition_iax_single`), or if it ended up NaN there and was excluded from further partitioning.
+
+    Parameters:
+        rooted (RootedTree): The tree rooted at the target node.
+        present (np.ndarray): A boolean (segment, itype) mask of the itypes present in each segment.
+        im (np.ndarray): The (segment, time point, itype) slab of membrane currents after `get_partitioning_factors`.
+
+    Returns:
+        np.ndarray: A boolean (segment, time point, itype) mask.
+    """
+    reaching = np.zeros(im.shape, dtype=bool)
+    reaching[rooted.target] = present[rooted.target]
+    for level_depth in range(1, rooted.depth.max() + 1):
+        level = np.flatnonzero(rooted.depth == level_depth)
+        reaching[level] = present[level][:, None, :] & ~np.isnan(im[level]) & reaching[rooted.parent[level]]
+    return reaching
+
+
+def get_partitioning_factors(rooted: RootedTree, children: np.ndarray, parents: np.ndarray, iax_edges: np.ndarray, im: np.ndarray, present: np.ndarray, outward: bool) -> np.ndarray:
+    """
+    Computes the partitioning factor of every edge with a level-synchronous leaf-to-target sweep.
+
+    The factor of an edge is its axial current divided by the total membrane current partitioned at the child,
+    i.e. the ratio used by `get_part_out`/`get_part_in` for all components of the child at once. As in
+    `get_part_out`, a child without outward currents passes NaN components to its parent.
+
+    Parameters:
+        rooted (RootedTree): The tree rooted at the target node.
+        children (np.ndarray): The child node codes of the edges in partitioning order.
+        parents (np.ndarray): The parent node codes of the edges in partitioning order.
+        iax_edges (np.ndarray): The (edge, time point) axial currents, signed from the perspective of the child.
+        im (np.ndarray): A (segment, time point, itype) slab of clipped membrane currents, updated in place.
+        present (np.ndarray): A boolean (segment, itype) mask of the itypes present in each segment.
+        outward (bool): Whether outward ("out" traversal) or inward ("in" traversal) currents are partitioned.
+
+    Returns:
+        np.ndarray: The (edge, time point) partitioning factors, zero where the child has nothing to partition.
+    """
+    factors = np.zeros(iax_edges.shape)
+    child_depth = rooted.depth[children]
+    for level_depth in np.unique(child_depth)[::-1]:
+        level = np.flatnonzero(child_depth == level_depth)
+        factors[level] = partition_iax_level(children[level], parents[level], iax_edges[level], im, present, outward)
+    return factors
+
+
+def partition_iax_level(refs: np.ndarray, pars: np.ndarray, iax_level: np.ndarray, im: np.ndarray, present: np.ndarray, outward: bool) -> np.ndarray:
+    """
+    Partitions the axial currents of a set of independent edges at once (no reference node may be a parent node).
+
+    Parameters:
+        refs (np.ndarray): The segment codes of the reference nodes (nodes whose currents are partitioned).
+        pars (np.ndarray): The segment codes of the parent nodes (nodes receiving the partitioned currents).
+        iax_level (np.ndarray): The (edge, time point) axial currents, signed from the perspective of the reference node.
+        im (np.ndarray): A (segment, time point, itype) slab of clipped membrane currents, updated in place.
+        present (np.ndarray): A boolean (segment, itype) mask of the itypes present in each segment.
+        outward (bool): Whether outward (`get_part_out`) or inward (`get_part_in`) currents are partitioned.
+
+    Returns:
+        np.ndarray: The (edge, time point) partitioning factors, zero where the reference node has nothing to partition.
+    """
+    im_ref = im[refs]
+    taking_part = present[refs][:, None, :] & (im_ref >= 0 if outward else im_ref < 0)
+    ref_sum = np.where(taking_part, im_ref, 0).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        factors = iax_level / ref_sum
+        part_curr = np.where(taking_part & present[pars][:, None, :], factors[..., None] * im_ref, 0)
+    np.add.at(im, pars, part_curr)
+    return np.where(ref_sum != 0, factors, 0)
+
+
+def get_origin_weights(rooted: RootedTree, children: np.ndarray, factors: np.ndarray) -> np.ndarray:
+    """
+    Computes the weight with which the membrane currents of every segment reach the root.
+
+    The weights solve the lower-triangular system (I - A) w = e_root, where A holds the partitioning factor of
+    every traversed edge at (child, parent) and nodes are numbered in preorder, so that the weight of a child is its
+    factor times the weight of its parent. All time points of the block are
+    solved at once as a block-diagonal system.
+
+    Parameters:
+        rooted (RootedTree): The tree rooted at the target node.
+        children (np.ndarray): The child node codes of the traversed edges.
+        factors (np.ndarray): The (edge, time point) partitioning factors.
+
+    Returns:
+        np.ndarray: The (segment, time point) weights, zero for segments that are not traversed.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.linalg import spsolve_triangular
+
+    preorder = rooted.preorder["out"]
+    position = np.full(len(rooted.parent), -1)
+    position[preorder] = np.arange(len(preorder))
+    n_tp = factors.shape[1]
+    offsets = np.arange(n_tp) * len(preorder)
+    size = n_tp * len(preorder)
+
+    rows = (position[children][:, None] + offsets).ravel()
+    columns = (position[rooted.parent[children]][:, None] + offsets).ravel()
+    diagonal = np.arange(size)
+    operator = csr_matrix((np.concatenate([np.ones(size), -factors.ravel()]),
+                           (np.concatenate([diagonal, rows]), np.concatenate([diagonal, columns]))), shape=(size, size))
+    root_indicator = np.zeros(size)
+    root_indicator[offsets] = 1
+
+    weights = np.zeros((len(rooted.parent), n_tp))
+    weights[preorder] = spsolve_triangular(operator, root_indicator, lower=True).reshape(n_tp, len(preorder)).T
+    return weights
+
+
+def partition_iax_parallel(im: DataFrame, iax: DataFrame, timepoints: list, target: str, max_workers: int = None, chunk_size: int = None, worker_engine: str = "batched", **engine_options) -> tuple[DataFrame, DataFrame]:
+    """
+    Parallel implementation of `partition_iax`, partitioning chunks of the time points in worker processes.
+
+    Parameters:
+        im, iax, timepoints, target: See `partition_iax`.
+        max_workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int, optional): The number of time points per task, see `TimepointPool.partition`.
+        worker_engine (str): The engine partitioning the time points of a chunk (any engine of `partition_iax` except "parallel").
+        **engine_options: Additional keyword arguments passed to the worker engine (e.g. `block_size`).
+
+    Returns:
+        tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target node.
+    """
+    with TimepointPool(im, iax, target, max_workers, worker_engine, **engine_options) as pool:
+        return pool.partition(timepoints, chunk_size)
+
+
+class TimepointPool:
+    """
+    Process pool partitioning the time points of a single pair of `im` and `iax` DataFrames in parallel.
+
+    The values of `im` and `iax` are shared with the workers without pickling (see `shared_arrays.share_array`):
+    memory-mapped values are mapped again from their file by every worker, other values are copied once into shared
+    memory. Only the indices (once per worker), the time points of every chunk and the partitioned currents of the
+    target are sent between the processes. Every worker keeps its own `PartitioningOrderCache` across chunks.
+    """
+
+    def __init__(self, im: DataFrame, iax: DataFrame, target: str, max_workers: int = None, engine: str = "batched", **engine_options):
+        """
+        Parameters:
+            im (DataFrame): A DataFrame containing membrane currents for each node and time point.
+            iax (DataFrame): A DataFrame containing axial currents for each reference-parent pair and time point.
+            target (str): The target node to start the partitioning traversal from.
+            max_workers (int, optional): The number of worker processes. Defaults to the number of CPUs.
+            engine (str): The `partition_iax` engine used by the workers.
+            **engine_options: Additional keyword arguments passed to the engine (e.g. `block_size`).
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.blocks = []
+        frames = []
+        for df in (im, iax):
+            descriptor, block = share_array(df.to_numpy())
+            if block is not None:
+                self.blocks.append(block)
+            frames.append((descriptor, df.index, df.columns))
+        self.executor = ProcessPoolExecutor(self.max_workers, initializer=init_partitioning_worker,
+                                            initargs=(frames, target, engine, engine_options))
+
+    def partition(self, timepoints: list, chunk_size: int = None) -> tuple[DataFrame, DataFrame]:
+        """
+        Partitions the axial currents of the time points, split into contiguous chunks processed by the workers.
+
+        Parameters:
+            timepoints (list): The time points (column labels of `im` and `iax`) to partition.
+            chunk_size (int, optional): The number of time points per task. Defaults to an even split across the workers.
+
+        Returns:
+            tuple[DataFrame, DataFrame]: Partitioned positive and negative membrane currents of the target node,
+            with the time points in the given order.
+        """
+        timepoints = list(timepoints)
+        chunk_size = chunk_size or max(1, -(-len(timepoints) // self.max_workers))
+        chunks = [timepoints[start:start + chunk_size] for start in range(0, len(timepoints), chunk_size)] or [[]]
+        results = list(self.executor.map(partition_iax_worker, chunks))
+        return pd.concat([part_pos for part_pos, _ in results], axis=1), pd.concat([part_neg for _, part_neg in results], axis=1)
+
+    def close(self) -> None:
+        """Shuts the workers down and releases the shared memory."""
+        self.executor.shutdown()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_partitioning_worker = {}
+
+
+def init_partitioning_worker(frames: list, target: str, engine: str, engine_options: dict) -> None:
+    """Attaches the shared values of `TimepointPool` in a worker process."""
+    dfs = []
+    handles = []
+    for descriptor, index, columns in frames:
+        values, handle = attach_array(descriptor)
+        handles.append(handle)
+        dfs.append(DataFrame(values, index=index, columns=columns, copy=False))
+    im, iax = dfs
+    engine_options = dict(engine_options)
+    # The tree is rooted once per worker instead of once per chunk
+    if engine in ("array", "batched", "compact"):
+        engine_options["order_cache"] = get_order_cache(engine_options.get("order_cache"), iax, encode_im(im)[2], target)
+    _partitioning_worker.update(im=im, iax=iax, handles=handles, target=target, engine=engine, engine_options=engine_options)
+
+
+def partition_iax_worker(timepoints: list) -> tuple[DataFrame, DataFrame]:
+    """Partitions a chunk of time points in a worker process of `TimepointPool`."""
+    worker = _partitioning_worker
+    return partition_iax(worker["im"], worker["iax"], timepoints, worker["target"], engine=worker["engine"], **worker["engine_options"])
+
+
 if __name__ == '__main__':
     from utils import load_df
 
@@ -1,4 +1,9 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+
 import networkx as nx
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from networkx import DiGraph
@@ -102,3 +107,309 @@ def get_traversal_order_in(dg: DiGraph, target: str) -> list[tuple[str, str]]:
     node_pairs_in = [(v, u) for (u, v) in edges_visited_in]  # switch nodes of each edge
     node_pairs_in.reverse()  # reverse node pairs order (to start from the leaf nodes)
     return node_pairs_in
+
+
+@dataclass(frozen=True)
+class SegmentTree:
+    """
+    Integer-coded representation of the ref/par tree of the axial currents.
+
+    Attributes:
+        nodes (pd.Index): The segment names; the position of a name is its node code.
+        ref (np.ndarray): The node code of the reference segment of every edge (row of `iax`).
+        par (np.ndarray): The node code of the parent segment of every edge (row of `iax`).
+        indptr (np.ndarray): CSR row pointers of the undirected adjacency, indexed by node code.
+        neighbors (np.ndarray): CSR neighbor node codes, sorted by edge row for every node.
+        edges (np.ndarray): The edge row connecting each node to the neighbor at the same CSR position.
+        first_seen (np.ndarray): The first edge row in which each node appears.
+    """
+    nodes: pd.Index
+    ref: np.ndarray
+    par: np.ndarray
+    indptr: np.ndarray
+    neighbors: np.ndarray
+    edges: np.ndarray
+    first_seen: np.ndarray
+
+
+@dataclass(frozen=True)
+class RootedTree:
+    """
+    A `SegmentTree` rooted at a target node, with the preorders used to derive partitioning orders.
+
+    Attributes:
+        tree (SegmentTree): The underlying tree.
+        target (int): The node code of the root.
+        parent (np.ndarray): The parent node code of every node (-1 for the root and unreachable nodes).
+        parent_edge (np.ndarray): The edge row connecting every node to its parent (-1 for the root and unreachable nodes).
+        child_is_ref (np.ndarray): Whether a node is the `ref` side of the edge to its parent.
+        depth (np.ndarray): The number of edges between every node and the root (-1 for unreachable nodes).
+        preorder (dict[str, np.ndarray]): Node codes in DFS preorder for the "out" and "in" directions.
+        subtree_end (dict[str, np.ndarray]): For every node, the preorder position after its subtree, per direction.
+    """
+    tree: SegmentTree
+    target: int
+    parent: np.ndarray
+    parent_edge: np.ndarray
+    child_is_ref: np.ndarray
+    depth: np.ndarray
+    preorder: dict
+    subtree_end: dict
+
+
+def create_segment_tree(iax: DataFrame, nodes: pd.Index = None) -> SegmentTree:
+    """
+    Creates the integer-coded tree of segments from the ref/par index of the axial currents.
+
+    Parameters:
+        iax (DataFrame): A DataFrame with axial current data, indexed by 'ref' and 'par' segments.
+        nodes (pd.Index, optional): The segment names defining the node codes (e.g. the segments of the membrane
+                                    currents). Defaults to the segments in order of their first appearance in `iax`.
+
+    Returns:
+        SegmentTree: The tree with edges in the row order of `iax`.
+    """
+    ref_names = iax.index.get_level_values("ref")
+    par_names = iax.index.get_level_values("par")
+    if nodes is None:
+        interleaved = np.column_stack([np.asarray(ref_names, dtype=object), np.asarray(par_names, dtype=object)]).ravel()
+        nodes = pd.Index(pd.unique(interleaved))
+    ref = nodes.get_indexer(ref_names)
+    par = nodes.get_indexer(par_names)
+    if (ref < 0).any() or (par < 0).any():
+        missing = set(ref_names[ref < 0]) | set(par_names[par < 0])
+        raise KeyError(f"Segments not found among the nodes: {sorted(missing)}")
+
+    n_nodes = len(nodes)
+    rows = np.arange(len(ref))
+    first_seen = np.full(n_nodes, len(ref))
+    np.minimum.at(first_seen, ref, rows)
+    np.minimum.at(first_seen, par, rows)
+
+    # Undirected CSR adjacency; the stable sort keeps the neighbors of every node in edge row order
+    ends = np.concatenate([ref, par])
+    others = np.concatenate([par, ref])
+    edge_rows = np.concatenate([rows, rows])
+    order = np.lexsort((edge_rows, ends))
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ends, minlength=n_nodes), out=indptr[1:])
+    return SegmentTree(nodes, ref, par, indptr, others[order], edge_rows[order], first_seen)
+
+
+def root_segment_tree(tree: SegmentTree, target: str) -> RootedTree:
+    """
+    Roots the tree at the target node with a level-synchronous breadth first search.
+
+    Parameters:
+        tree (SegmentTree): The integer-coded tree.
+        target (str): The node from which the traversals start.
+
+    Returns:
+        RootedTree: The rooted tree with the preorders of the "out" and "in" traversals.
+    """
+    n_nodes = len(tree.nodes)
+    root = tree.nodes.get_loc(target)
+    parent = np.full(n_nodes, -1)
+    parent_edge = np.full(n_nodes, -1)
+    levels = [np.array([root])]
+    while True:
+        frontier = levels[-1]
+        starts, stops = tree.indptr[frontier], tree.indptr[frontier + 1]
+        counts = stops - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        sources = np.repeat(frontier, counts)
+        neighbors = tree.neighbors[positions]
+        keep = neighbors != parent[sources]
+        if not keep.any():
+            break
+        parent[neighbors[keep]] = sources[keep]
+        parent_edge[neighbors[keep]] = tree.edges[positions[keep]]
+        levels.append(neighbors[keep])
+
+    child_is_ref = np.zeros(n_nodes, dtype=bool)
+    children = np.concatenate(levels[1:]) if len(levels) > 1 else np.array([], dtype=int)
+    child_is_ref[children] = tree.ref[parent_edge[children]] == children
+    depth = np.full(n_nodes, -1)
+    for level_depth, level in enumerate(levels):
+        depth[level] = level_depth
+
+    subtree_size = np.ones(n_nodes, dtype=np.int64)
+    for level in reversed(levels[1:]):
+        np.add.at(subtree_size, parent[level], subtree_size[level])
+
+    # Children are visited in the adjacency order of the networkx graphs: edge row order for the "out"
+    # traversal and order of first appearance for the "in" traversal (which runs on the reversed graph)
+    sibling_keys = {"out": parent_edge, "in": tree.first_seen}
+    preorder, subtree_end = {}, {}
+    for direction, key in sibling_keys.items():
+        siblings = children[np.lexsort((key[children], parent[children]))]
+        sizes = subtree_size[siblings]
+        offsets = np.cumsum(sizes) - sizes
+        group_starts = np.diff(parent[siblings], prepend=-1) != 0
+        offsets -= np.maximum.accumulate(np.where(group_starts, offsets, 0))
+        sibling_offset = np.zeros(n_nodes, dtype=np.int64)
+        sibling_offset[siblings] = offsets
+
+        position = np.zeros(n_nodes, dtype=np.int64)
+        for level in levels[1:]:
+            position[level] = position[parent[level]] + 1 + sibling_offset[level]
+        reached = np.concatenate(levels)
+        order = np.empty(len(reached), dtype=np.int64)
+        order[position[reached]] = reached
+        preorder[direction] = order
+        subtree_end[direction] = position + subtree_size
+    return RootedTree(tree, root, parent, parent_edge, child_is_ref, depth, preorder, subtree_end)
+
+
+def get_partitioning_order_codes(rooted: RootedTree, iax_tp: np.ndarray, direction: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Array counterpart of `get_partitioning_order`, working on node codes instead of a networkx graph.
+
+    The edges are oriented by the sign of the axial currents (as in `create_directed_graph`). Subtrees hanging
+    from an edge pointing against the traversal direction, or from an edge with a NaN axial current (which
+    `create_directed_graph` leaves out of the graph), are cut from the preorder, and the remaining edges are returned
+    starting from the leaf nodes.
+
+    Parameters:
+        rooted (RootedTree): The tree rooted at the target node.
+        iax_tp (np.ndarray): The axial current of every edge (row of `iax`) at one time point.
+        direction (str): The traversal direction. Options are:
+                         - "out": Outward traversal from the target node.
+                         - "in": Inward traversal towards the target node.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The node codes of the (child, parent) pairs in traversal order,
+        and the edge row connecting each pair.
+    """
+    missing = np.isnan(iax_tp)
+    if missing.any() and direction == "in":
+        # The nodes of the graph are inserted in the order of the edges that are added, which determines the
+        # order of the siblings in the "in" traversal
+        tree = rooted.tree
+        rows = np.flatnonzero(~missing)
+        first_seen = np.full(len(tree.nodes), len(tree.ref))
+        np.minimum.at(first_seen, tree.ref[rows], rows)
+        np.minimum.at(first_seen, tree.par[rows], rows)
+        rooted = root_segment_tree(replace(tree, first_seen=first_seen), tree.nodes[rooted.target])
+    preorder = rooted.preorder[direction]
+    nodes = preorder[1:]
+    edges = rooted.parent_edge[nodes]
+    # The edge points away from the target if it runs par -> ref (iax >= 0) and the child is the ref, or vice versa
+    points_out = (iax_tp[edges] >= 0) == rooted.child_is_ref[nodes]
+    blocked = nodes[(~points_out if direction == "out" else points_out) | missing[edges]]
+
+    # Mark the preorder intervals of all blocked subtrees with a difference array
+    n_reached = len(preorder)
+    position = np.empty(len(rooted.parent), dtype=np.int64)
+    position[preorder] = np.arange(n_reached)
+    coverage = np.zeros(n_reached + 1, dtype=np.int64)
+    np.add.at(coverage, position[blocked], 1)
+    np.add.at(coverage, rooted.subtree_end[direction][blocked], -1)
+    reachable = np.cumsum(coverage[:n_reached])[1:] == 0
+
+    children = nodes[reachable][::-1]
+    return children, rooted.parent[children], rooted.parent_edge[children]
+
+
+def get_partitioning_order_array(tree: SegmentTree, iax: DataFrame, tp: int, target: str, direction: str) -> list[tuple[str, str]]:
+    """
+    Determines the partitioning order with the array-based traversal, returning the same node pairs as `get_partitioning_order`.
+
+    Parameters:
+        tree (SegmentTree): The integer-coded tree of the axial currents.
+        iax (DataFrame): A pandas DataFrame with axial current data.
+        tp (int): The time point for which the traversal order is computed.
+        target (str): The node from which the traversal starts.
+        direction (str): The traversal direction ("out" or "in").
+
+    Returns:
+        list[tuple[str, str]]: A list of node pairs representing the traversal order.
+    """
+    rooted = root_segment_tree(tree, target)
+    children, parents, _ = get_partitioning_order_codes(rooted, iax[tp].to_numpy(), direction)
+    return list(zip(tree.nodes[children], tree.nodes[parents]))
+
+
+class PartitioningOrderCache:
+    """
+    LRU cache of the out/in partitioning orders of a rooted tree, keyed on the sign pattern of the axial currents.
+
+    The partitioning orders only depend on the sign of every axial current, which rarely changes between
+    neighbouring time points. The key is a 128-bit digest of the packed per-edge sign bitmask.
+
+    Attributes:
+        rooted (RootedTree): The tree rooted at the target node.
+        maxsize (int): The maximum number of sign patterns kept; the least recently used one is evicted first.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that computed the orders.
+    """
+
+    def __init__(self, rooted: RootedTree, maxsize: int = 128):
+        self.rooted = rooted
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._orders = OrderedDict()
+
+    def get_partitioning_orders(self, iax_tp: np.ndarray) -> dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Returns the partitioning orders for the sign pattern of the axial currents at one time point.
+
+        Parameters:
+            iax_tp (np.ndarray): The axial current of every edge (row of `iax`) at one time point.
+
+        Returns:
+            dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]]: The output of `get_partitioning_order_codes`
+            for the "out" and "in" directions.
+        """
+        key = get_sign_pattern_key(iax_tp)
+        orders = self._orders.get(key)
+        if orders is not None:
+            self.hits += 1
+            self._orders.move_to_end(key)
+            return orders
+
+        self.misses += 1
+        orders = {direction: get_partitioning_order_codes(self.rooted, iax_tp, direction) for direction in ("out", "in")}
+        self._orders[key] = orders
+        if len(self._orders) > self.maxsize:
+            self._orders.popitem(last=False)
+        return orders
+
+    def cache_info(self) -> dict[str, int]:
+        """Returns the hit and miss counters with the current and maximum size of the cache."""
+        return {"hits": self.hits, "misses": self.misses, "maxsize": self.maxsize, "currsize": len(self._orders)}
+
+
+def get_sign_pattern_key(iax_tp: np.ndarray) -> bytes:
+    """
+    Computes a compact key of the sign pattern of the axial currents, matching the edge orientation of `create_directed_graph`.
+
+    Parameters:
+        iax_tp (np.ndarray): The axial current of every edge at one time point.
+
+    Returns:
+        bytes: A 16 byte digest of the packed bitmasks of non-negative and of NaN axial currents.
+    """
+    return hashlib.blake2b(np.packbits(np.concatenate([iax_tp >= 0, np.isnan(iax_tp)])).tobytes(), digest_size=16).digest()
+
+
+def group_timepoints_by_sign(iax_values: np.ndarray) -> list[np.ndarray]:
+    """
+    Groups the time points (columns) of the axial currents sharing the same sign pattern, and thus the same partitioning orders.
+
+    Parameters:
+        iax_values (np.ndarray): An (edge, time point) array of axial currents.
+
+    Returns:
+        list[np.ndarray]: The column positions of every group, in order of the first time point of the group.
+    """
+    if iax_values.shape[1] == 0:
+        return []
+    # NaN axial currents leave their edge out of the graph, so they form a sign of their own
+    packed = np.packbits(np.concatenate([iax_values >= 0, np.isnan(iax_values)]), axis=0)
+    _, first, inverse = np.unique(packed, axis=1, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    columns = np.argsort(inverse, kind='stable')
+    groups = np.split(columns, np.cumsum(np.bincount(inverse))[:-1])
+    return [groups[i] for i in np.argsort(first)]
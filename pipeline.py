@@ -0,0 +1,114 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from pandas import DataFrame
+
+_DONE = object()
+
+
+def prefetch(items, load, depth: int = 1):
+    """
+    Yields `load(item)` for every item, loading the next items in a background thread while the current one is used.
+
+    At most `depth` loaded items wait in a bounded queue, so a slow consumer stops the reader (backpressure). An
+    exception raised by `load` is raised in the consumer when the failed item is reached. Closing the generator
+    stops the reader.
+
+    Parameters:
+        items (iterable): The items to load, in order.
+        load (callable): Loads a single item (e.g. reads a window of timepoints into memory).
+        depth (int): The maximum number of loaded items waiting to be used. 0 loads every item when it is requested.
+
+    Yields:
+        The loaded items, in the order of `items`.
+    """
+    if depth < 1:
+        for item in items:
+            yield load(item)
+        return
+
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                loaded.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((load(item), None)):
+                    return
+        except BaseException as error:
+            put((None, error))
+            return
+        put((_DONE, None))
+
+    reader = threading.Thread(target=read, name='prefetch', daemon=True)
+    reader.start()
+    try:
+        while True:
+            result, error = loaded.get()
+            if error is not None:
+                raise error
+            if result is _DONE:
+                return
+            yield result
+    finally:
+        stop.set()
+        reader.join()
+
+
+class BackgroundWriter:
+    """
+    Wraps a table writer of `output_writer.get_output_writer`, appending and closing in a background thread.
+
+    The chunks of a table are written in the order they are appended. At most `max_pending` chunks wait to be
+    written, further appends block until a chunk is written (backpressure). Errors of the background writes are
+    raised by the next `append` or by `close`.
+    """
+
+    def __init__(self, writer, max_pending: int = 2):
+        """
+        Parameters:
+            writer (NpyChunkWriter | CsvWriter): The writer doing the actual writes.
+            max_pending (int): The maximum number of chunks waiting to be written.
+        """
+        self.writer = writer
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.futures = deque()
+
+    def append(self, df: DataFrame) -> None:
+        """Queues the columns of a DataFrame to be appended, blocking while `max_pending` chunks are queued."""
+        self._raise_errors()
+        self.pending.acquire()
+        future = self.executor.submit(self.writer.append, df)
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+
+    def close(self) -> None:
+        """Waits for the queued chunks and closes the writer."""
+        try:
+            while self.futures:
+                self.futures.popleft().result()
+            self.executor.submit(self.writer.close).result()
+        finally:
+            self.executor.shutdown()
+
+    def _raise_errors(self) -> None:
+        while self.futures and self.futures[0].done():
+            self.futures.popleft().result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,206 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, asdict, field
+
+
+@dataclass
+class JobResult:
+    """
+    Outcome of a single job of the scheduler.
+
+    Attributes:
+        job_id (str): The identifier of the job (the file number for file pairs).
+        status (str): "done", "failed", "skipped" (already done according to the manifest), "unpaired" (input
+                      file without a partner) or "claimed" (being processed by another node, see `main.run_shards`).
+        args (tuple): The arguments the job was called with.
+        duration (float): The wall time of the job in seconds.
+        error (str): The traceback of a failed job.
+        details (dict): Additional information returned by the job function (if it returns a dictionary).
+    """
+    job_id: str
+    status: str
+    args: tuple
+    duration: float = 0.0
+    error: str = None
+    details: dict = field(default_factory=dict)
+
+
+def pair_files(im_files: list[str], iax_files: list[str], key) -> tuple[list[tuple[str, str, str]], list[str]]:
+    """
+    Pairs membrane and axial current files by a key extracted from their file names.
+
+    Parameters:
+        im_files (list[str]): The membrane current files.
+        iax_files (list[str]): The axial current files.
+        key (callable): Extracts the pairing key (e.g. the file number) from a file path.
+
+    Returns:
+        tuple[list[tuple[str, str, str]], list[str]]: The (key, im file, iax file) triples sorted by key (numerically
+        where possible), and the files without a partner. Files sharing their key with another file of the same kind
+        cannot be paired unambiguously and are all returned as unpaired.
+    """
+    im_by_key, iax_by_key = {}, {}
+    for files, by_key in ((im_files, im_by_key), (iax_files, iax_by_key)):
+        for f in files:
+            by_key.setdefault(key(f), []).append(f)
+    unique = {k for k, files in im_by_key.items() if len(files) == 1} & {k for k, files in iax_by_key.items() if len(files) == 1}
+    common = sorted(im_by_key.keys() & iax_by_key.keys() & unique, key=lambda k: (not k.isdigit(), int(k) if k.isdigit() else 0, k))
+    unpaired = sorted(f for by_key in (im_by_key, iax_by_key) for k, files in by_key.items() if k not in common for f in files)
+    return [(k, im_by_key[k][0], iax_by_key[k][0]) for k in common], unpaired
+
+
+def read_manifest(manifest_path: str) -> dict[str, dict]:
+    """
+    Reads the completion manifest (one JSON record per line), keeping the last record of every job.
+
+    Parameters:
+        manifest_path (str): The path of the manifest.
+
+    Returns:
+        dict[str, dict]: The last record of every job, by job id.
+    """
+    records = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record['job_id']] = record
+    return records
+
+
+def get_worker_count(max_workers: int = None, memory_per_job: int = None, memory_limit: int = None) -> int:
+    """
+    Determines how many jobs can run concurrently.
+
+    Parameters:
+        max_workers (int, optional): The maximum number of workers. Defaults to the number of CPUs.
+        memory_per_job (int, optional): The expected peak memory of a job in bytes.
+        memory_limit (int, optional): The memory available to all jobs in bytes. Defaults to the physical memory.
+
+    Returns:
+        int: The number of workers, at least one.
+    """
+    workers = max_workers or os.cpu_count() or 1
+    if memory_per_job:
+        if memory_limit is None and hasattr(os, 'sysconf'):
+            memory_limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        if memory_limit:
+            workers = min(workers, memory_limit // memory_per_job)
+    return max(1, workers)
+
+
+def run_jobs(jobs: list[tuple[str, tuple]], job_fn, manifest_path: str, max_workers: int = None,
+             memory_per_job: int = None, memory_limit: int = None, resume: bool = True) -> list[JobResult]:
+    """
+    Runs jobs on a long-lived process pool, skipping the jobs already completed according to the manifest.
+
+    Every finished job is appended to the manifest as soon as it completes, so an interrupted run resumes where it
+    stopped when rerun with the same manifest. At most one job per worker is submitted at a time: if a worker dies
+    (e.g. killed when running out of memory), the pool breaks, the jobs that were running on it are retried one at
+    a time on a pool of a single worker (so only the job that kills its worker alone is recorded as failed), and the
+    remaining jobs continue on a new pool.
+
+    Parameters:
+        jobs (list[tuple[str, tuple]]): The (job id, arguments) of every job.
+        job_fn (callable): The (picklable) function called with the arguments of a job.
+        manifest_path (str): The path of the completion manifest.
+        max_workers (int, optional): The maximum number of concurrent jobs, see `get_worker_count`.
+        memory_per_job (int, optional): The expected peak memory of a job in bytes, see `get_worker_count`.
+        memory_limit (int, optional): The memory available to all jobs in bytes, see `get_worker_count`.
+        resume (bool): Whether to skip the jobs completed according to the manifest. Otherwise, the manifest only
+                       records the results.
+
+    Returns:
+        list[JobResult]: The result of every job, in the order of `jobs`.
+    """
+    completed = read_manifest(manifest_path) if resume else {}
+    results = {}
+    pending = []
+    for job_id, args in jobs:
+        if completed.get(job_id, {}).get('status') == 'done':
+            results[job_id] = JobResult(job_id, 'skipped', tuple(args))
+        else:
+            pending.append((job_id, tuple(args)))
+
+    if pending:
+        workers = min(len(pending), get_worker_count(max_workers, memory_per_job, memory_limit))
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+        pending.reverse()
+        running = {}
+        # The jobs running on a pool that broke are retried one at a time: any of them may have killed its worker,
+        # and only a job breaking a pool it ran on alone is recorded as failed
+        retry = []
+        executor, pool_size = None, 0
+        with open(manifest_path, 'a') as manifest:
+            try:
+                while pending or retry or running:
+                    size = 1 if retry else workers
+                    if executor is not None and not running and pool_size != size:
+                        executor.shutdown(wait=True)
+                        executor = None
+                    if executor is None:
+                        executor, pool_size = ProcessPoolExecutor(max_workers=size), size
+                    queue = retry or pending
+                    while queue and len(running) < pool_size:
+                        job_id, args = queue.pop()
+                        try:
+                            running[executor.submit(run_job, job_fn, job_id, args)] = (job_id, args)
+                        except BrokenProcessPool:
+                            # The pool broke since the last wait, the jobs still running on it fail in the next one
+                            queue.append((job_id, args))
+                            break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    # A dead worker breaks the pool and all jobs running on it (nothing is done if the pool broke
+                    # without any running job)
+                    broken = not done or any(is_broken(future) for future in done)
+                    suspects = []
+                    for future in list(done) + (list(running.keys() - done) if broken else []):
+                        job_id, args = running.pop(future)
+                        try:
+                            result = future.result()
+                        except BrokenProcessPool:
+                            if pool_size > 1:
+                                suspects.append((job_id, args))
+                                continue
+                            result = JobResult(job_id, 'failed', args, error=traceback.format_exc())
+                        results[job_id] = result
+                        manifest.write(json.dumps(asdict(result)) + '\n')
+                        manifest.flush()
+                    retry = suspects[::-1] + retry
+                    if broken:
+                        executor.shutdown(wait=True)
+                        executor = None
+            finally:
+                if executor is not None:
+                    executor.shutdown(wait=True)
+    return [results[job_id] for job_id, _ in jobs]
+
+
+def is_broken(future) -> bool:
+    """Whether a finished future failed because its process pool broke."""
+    return isinstance(future.exception(), BrokenProcessPool)
+
+
+def run_job(job_fn, job_id: str, args: tuple) -> JobResult:
+    """
+    Runs a single job in a worker, timing it and capturing its error instead of raising.
+
+    Parameters:
+        job_fn (callable): The function of the job.
+        job_id (str): The identifier of the job.
+        args (tuple): The arguments of the job.
+
+    Returns:
+        JobResult: The outcome of the job.
+    """
+    start = time.perf_counter()
+    try:
+        details = job_fn(*args)
+    except Exception:
+        return JobResult(job_id, 'failed', args, time.perf_counter() - start, traceback.format_exc())
+    return JobResult(job_id, 'done', args, time.perf_counter() - start, details=details if isinstance(details, dict) else {})
@@ -0,0 +1,255 @@
+import glob
+import json
+import os
+import socket
+import tempfile
+
+import numpy as np
+
+from output_writer import get_output_writer, iter_output
+from scheduler import pair_files
+
+# Output tables of a file pair and the directories they are written to
+OUTPUT_TABLES = {
+    'im_part_pos': 'partitioned_currents',
+    'im_part_neg': 'partitioned_currents',
+    'soma_pos': 'soma_currents',
+    'soma_neg': 'soma_currents',
+    'itotal_pos': 'total_currents',
+    'itotal_neg': 'total_currents'
+}
+SHARDS_DIR = 'shards'
+SHARD_RECORD = 'shard.json'
+SHARD_LOCK = 'shard.lock'
+
+
+def extract_file_number(filepath):
+    """Extract the number from the file name."""
+    filename = os.path.basename(filepath)
+    number = ''.join(filter(str.isdigit, filename))
+    return number
+
+
+def get_table_path(output_dir: str, name: str, file_number: str) -> str:
+    """Returns the output path (without file extension) of a table of a file pair, see `OUTPUT_TABLES`."""
+    return os.path.join(output_dir, OUTPUT_TABLES[name], f"{name}_{file_number}")
+
+
+def create_shard_manifest(input_dir: str, output_dir: str, segment: str = 'soma', start: int = 0, stop: int = None,
+                          shard_size: int = None) -> dict:
+    """
+    Splits the work of an input directory into shards that can be processed independently.
+
+    Membrane and axial current files are paired by their file number, and the timepoints `start <= t < stop` of
+    every pair are split into contiguous ranges of at most `shard_size` timepoints. Only the headers of the `.npy`
+    files are read.
+
+    Parameters:
+        input_dir (str): The directory of the preprocessed currents (`axial_currents_merged_soma` and
+                         `membrane_currents_merged_soma` with a `multiindex_merged_soma.csv` and `.npy` files each).
+        output_dir (str): The directory of the shard outputs and the merged tables.
+        segment (str): The target segment of the partitioning.
+        start (int): The first timepoint.
+        stop (int, optional): The timepoint after the last one. Defaults to the number of timepoints of every file.
+        shard_size (int, optional): The maximum number of timepoints of a shard. Defaults to whole files.
+
+    Returns:
+        dict: The manifest, with the index files, the shards (id, file number, files and timepoint range) and the
+        files without a partner.
+
+    Raises:
+        ValueError: If the membrane and axial currents of a pair have a different number of timepoints.
+    """
+    iax_dir = os.path.join(input_dir, 'axial_currents_merged_soma')
+    im_dir = os.path.join(input_dir, 'membrane_currents_merged_soma')
+    file_pairs, unpaired = pair_files(glob.glob(os.path.join(im_dir, '*.npy')), glob.glob(os.path.join(iax_dir, '*.npy')),
+                                      key=extract_file_number)
+
+    shards = []
+    for number, im_file, iax_file in file_pairs:
+        n_timepoints = np.load(im_file, mmap_mode='r').shape[1]
+        if np.load(iax_file, mmap_mode='r').shape[1] != n_timepoints:
+            raise ValueError(f"The currents of file {number} have a different number of timepoints: {im_file}, {iax_file}")
+        file_stop = n_timepoints if stop is None else min(stop, n_timepoints)
+        step = shard_size or max(file_stop - start, 1)
+        for shard_start in range(start, file_stop, step):
+            shard_stop = min(shard_start + step, file_stop)
+            shards.append({'shard_id': f"{number}_{shard_start}-{shard_stop}", 'file_number': number,
+                           'im_file': os.path.abspath(im_file), 'iax_file': os.path.abspath(iax_file),
+                           'start': shard_start, 'stop': shard_stop})
+
+    return {'input_dir': os.path.abspath(input_dir), 'output_dir': os.path.abspath(output_dir), 'segment': segment,
+            'im_index_file': os.path.abspath(os.path.join(im_dir, 'multiindex_merged_soma.csv')),
+            'iax_index_file': os.path.abspath(os.path.join(iax_dir, 'multiindex_merged_soma.csv')),
+            'shards': shards, 'unpaired': [os.path.abspath(f) for f in unpaired]}
+
+
+def write_json(data: dict, path: str) -> None:
+    """Writes a JSON file atomically (to a temporary file in the same directory first)."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as tmp:
+        json.dump(data, tmp, indent=1)
+    os.replace(tmp.name, path)
+
+
+def read_json(path: str) -> dict:
+    """Reads a JSON file written by `write_json`."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def get_shard_dir(manifest: dict, shard_id: str) -> str:
+    """Returns the directory of the outputs and the completion record of a shard."""
+    return os.path.join(manifest['output_dir'], SHARDS_DIR, shard_id)
+
+
+def claim_shard(shard_dir: str) -> bool:
+    """
+    Claims a shard for this process, so that nodes running the same shards never write into the same directory.
+
+    The claim (`shard.lock`, holding the host and process id) is created atomically, and removed by `release_shard`
+    once the shard is processed. A claim of a process of this host that no longer runs is taken over.
+
+    Parameters:
+        shard_dir (str): The directory of the shard, see `get_shard_dir`.
+
+    Returns:
+        bool: Whether the shard was claimed, False if another process holds the claim.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    lock_path = os.path.join(shard_dir, SHARD_LOCK)
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            owner = read_shard_lock(shard_dir)
+            if owner is None or owner['host'] != socket.gethostname() or is_running(owner['pid']):
+                return False
+            release_shard(shard_dir)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid()}, f)
+        return True
+    return False
+
+
+def read_shard_lock(shard_dir: str) -> dict:
+    """Returns the host and process id of the claim of a shard, None if it is not claimed (or is being claimed)."""
+    try:
+        return read_json(os.path.join(shard_dir, SHARD_LOCK))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def release_shard(shard_dir: str) -> None:
+    """Removes the claim of a shard taken with `claim_shard`."""
+    try:
+        os.remove(os.path.join(shard_dir, SHARD_LOCK))
+    except FileNotFoundError:
+        pass
+
+
+def is_running(pid: int) -> bool:
+    """Whether a process of this host is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # running as another user
+        pass
+    return True
+
+
+def check_shards(manifest: dict) -> dict:
+    """
+    Compares the shards of a manifest with the completed shards in its output directory.
+
+    A shard is completed if its directory holds a completion record (written by `main.run_shard` after all of its
+    tables were written) for exactly the shard of the manifest, so the outputs of a shard of an older manifest with
+    the same id are not mistaken for a completed one.
+
+    Returns:
+        dict: The shard ids that are "completed", "failed" (completed shards whose partitioned currents exceed the
+        conservation tolerance), "claimed" (being processed, see `claim_shard`, with the host and process id of every
+        claim in "claims"), "missing" (not run, crashed or stale), "duplicate" (ids listed more than once, or shards
+        with overlapping timepoints of the same file) and "unexpected" (shard directories not in the manifest).
+    """
+    ids = [shard['shard_id'] for shard in manifest['shards']]
+    duplicate = {shard_id for shard_id in ids if ids.count(shard_id) > 1}
+    by_file = {}
+    for shard in manifest['shards']:
+        by_file.setdefault(shard['file_number'], []).append(shard)
+    for shards in by_file.values():
+        shards = sorted(shards, key=lambda shard: shard['start'])
+        for previous, shard in zip(shards, shards[1:]):
+            if shard['start'] < previous['stop']:
+                duplicate.update([previous['shard_id'], shard['shard_id']])
+
+    completed, failed, missing, claims = [], [], [], {}
+    for shard in manifest['shards']:
+        shard_dir = get_shard_dir(manifest, shard['shard_id'])
+        record_path = os.path.join(shard_dir, SHARD_RECORD)
+        record = read_json(record_path) if os.path.exists(record_path) else None
+        if os.path.exists(os.path.join(shard_dir, SHARD_LOCK)):
+            claims[shard['shard_id']] = read_shard_lock(shard_dir)
+        elif record is not None and record['shard'] == shard:
+            completed.append(shard['shard_id'])
+            if not record['result']['conservation'].get('passed', True):
+                failed.append(shard['shard_id'])
+        else:
+            missing.append(shard['shard_id'])
+
+    shards_root = os.path.join(manifest['output_dir'], SHARDS_DIR)
+    existing = sorted(os.listdir(shards_root)) if os.path.isdir(shards_root) else []
+    unexpected = [name for name in existing if name not in set(ids) and os.path.isdir(os.path.join(shards_root, name))]
+    return {'completed': completed, 'failed': failed, 'claimed': list(claims), 'claims': claims, 'missing': missing, 'duplicate': sorted(duplicate), 'unexpected': unexpected}
+
+
+def merge_shards(manifest: dict, output_format: str = 'npy') -> list[dict]:
+    """
+    Stitches the tables of the completed shards into the partitioned, soma and total current tables of every file.
+
+    The tables of the shards of a file are appended in timepoint order, chunk by chunk, so no more than a chunk of a
+    shard is held in memory. The merged tables are written like the tables of a single run (see `get_table_path`).
+
+    Parameters:
+        manifest (dict): The manifest of the shards, see `create_shard_manifest`.
+        output_format (str): The format of the merged tables, see `output_writer.get_output_writer`.
+
+    Returns:
+        list[dict]: For every file, the file number, the merged shards, the combined relative conservation errors and
+        the shards failing the conservation check (see `check_shards`).
+
+    Raises:
+        ValueError: If shards are missing, being processed or duplicated (see `check_shards`).
+    """
+    status = check_shards(manifest)
+    if status['missing'] or status['claimed'] or status['duplicate']:
+        raise ValueError(f"Cannot merge the shards: missing {status['missing']}, claimed {status['claimed']}, "
+                         f"duplicate {status['duplicate']}")
+
+    by_file = {}
+    for shard in sorted(manifest['shards'], key=lambda shard: shard['start']):
+        by_file.setdefault(shard['file_number'], []).append(shard)
+
+    results = []
+    for number, shards in by_file.items():
+        for name in OUTPUT_TABLES:
+            writer = get_output_writer(get_table_path(manifest['output_dir'], name, number), output_format)
+            for shard in shards:
+                for chunk in iter_output(get_table_path(get_shard_dir(manifest, shard['shard_id']), name, number), mmap_mode='r'):
+                    writer.append(chunk)
+            writer.close()
+
+        failed = [shard['shard_id'] for shard in shards if shard['shard_id'] in status['failed']]
+        conservations = [read_json(os.path.join(get_shard_dir(manifest, shard['shard_id']), SHARD_RECORD))['result']['conservation']
+                         for shard in shards]
+        n_timepoints = sum(conservation['n_timepoints'] for conservation in conservations)
+        max_error = max((conservation['max_relative_error'] for conservation in conservations if conservation['n_timepoints']), default=0.0)
+        mean_error = (sum(conservation['mean_relative_error'] * conservation['n_timepoints'] for conservation in conservations) / n_timepoints
+                      if n_timepoints else 0.0)
+        results.append({'file_number': number, 'shards': [shard['shard_id'] for shard in shards],
+                        'conservation': {'n_timepoints': n_timepoints, 'max_relative_error': max_error, 'mean_relative_error': mean_error,
+                                         'failed_shards': failed}})
+    return results
@@ -0,0 +1,71 @@
+import mmap
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def share_array(values: np.ndarray) -> tuple[dict, shared_memory.SharedMemory]:
+    """
+    Makes an array accessible to other processes without pickling its values.
+
+    Memory-mapped arrays (e.g. loaded with `utils.load_df_mmap`) are described by their file, byte offset and strides,
+    so other processes map the same pages. Other arrays are copied once into a shared memory block.
+
+    Parameters:
+        values (np.ndarray): The array to share.
+
+    Returns:
+        tuple[dict, shared_memory.SharedMemory]: The picklable descriptor of the array (see `attach_array`) and the
+        shared memory block holding the copy, which the caller must close and unlink after use (None for
+        memory-mapped arrays).
+    """
+    descriptor = {'shape': values.shape, 'dtype': values.dtype.str}
+    root = get_memmap_root(values)
+    if root is not None:
+        pointer = values.__array_interface__['data'][0]
+        root_pointer = root.__array_interface__['data'][0]
+        descriptor.update(kind='memmap', name=root.filename, offset=root.offset + pointer - root_pointer, strides=values.strides)
+        return descriptor, None
+
+    block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    shared = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+    shared[...] = values
+    descriptor.update(kind='shared_memory', name=block.name, offset=0, strides=shared.strides)
+    return descriptor, block
+
+
+def attach_array(descriptor: dict) -> tuple[np.ndarray, object]:
+    """
+    Opens an array shared by `share_array` in another process.
+
+    Parameters:
+        descriptor (dict): The descriptor returned by `share_array`.
+
+    Returns:
+        tuple[np.ndarray, object]: The read-only array and the memory map or shared memory block backing it, which
+        must be kept alive as long as the array is used.
+    """
+    if descriptor['kind'] == 'memmap':
+        buffer = np.memmap(descriptor['name'], dtype=np.uint8, mode='r')
+        handle = buffer
+    else:
+        handle = shared_memory.SharedMemory(name=descriptor['name'])
+        buffer = handle.buf
+    values = np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']), buffer=buffer,
+                        offset=descriptor['offset'], strides=descriptor['strides'])
+    values.flags.writeable = False
+    return values, handle
+
+
+def get_memmap_root(values: np.ndarray) -> np.memmap:
+    """
+    Returns the file-backed memory map an array is a view of, or None.
+
+    Views of a `np.memmap` inherit its `filename` and `offset` without adjusting them, so the base chain is followed
+    down to the array that owns the mapping.
+    """
+    while isinstance(values, np.ndarray):
+        if isinstance(values, np.memmap) and isinstance(values.base, mmap.mmap) and values.filename:
+            return values
+        values = values.base
+    return None
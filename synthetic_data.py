@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+ITYPES = ['ic', 'ipas', 'ina', 'ik', 'ica', 'ih', 'ikm', 'ikdr', 'ikca', 'ican', 'iampa', 'inmda', 'igaba']
+ALWAYS_PRESENT = ['ic', 'ipas']
+
+
+def create_synthetic_tree(n_segments: int, branching: float = 0.1, seed: int = 0) -> pd.MultiIndex:
+    """
+    Creates the ref/par multiindex of a synthetic neuron tree rooted at the soma.
+
+    Segments are added one by one. Each segment continues the previously added one, or with probability
+    `branching` starts a new branch from a random earlier segment.
+
+    Parameters:
+        n_segments (int): The number of segments, including the soma.
+        branching (float): The probability of starting a new branch.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        pd.MultiIndex: The ('ref', 'par') pairs of the tree, in random row order.
+    """
+    rng = np.random.default_rng(seed)
+    names = ['soma'] + [f'dend{i}' for i in range(1, n_segments)]
+    parents = [i - 1 if rng.random() >= branching else int(rng.integers(0, i)) for i in range(1, n_segments)]
+    rows = [(names[i], names[parent]) for i, parent in enumerate(parents, start=1)]
+    order = rng.permutation(len(rows))
+    return pd.MultiIndex.from_tuples([rows[i] for i in order], names=['ref', 'par'])
+
+
+def create_synthetic_itypes(segments: list[str], itypes_per_segment: int = 4, seed: int = 0) -> pd.MultiIndex:
+    """
+    Creates the segment/itype multiindex of the membrane currents.
+
+    Every segment carries the capacitive and passive currents plus a random selection of the other itypes,
+    the soma carries all of them.
+
+    Parameters:
+        segments (list[str]): The segment names.
+        itypes_per_segment (int): The number of itypes of every segment other than the soma.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        pd.MultiIndex: The ('segment', 'itype') pairs.
+    """
+    rng = np.random.default_rng(seed)
+    optional = [itype for itype in ITYPES if itype not in ALWAYS_PRESENT]
+    n_optional = int(np.clip(itypes_per_segment - len(ALWAYS_PRESENT), 0, len(optional)))
+    rows = []
+    for segment in segments:
+        itypes = ITYPES if segment == 'soma' else ALWAYS_PRESENT + list(rng.choice(optional, n_optional, replace=False))
+        rows += [(segment, itype) for itype in itypes]
+    return pd.MultiIndex.from_tuples(rows, names=['segment', 'itype'])
+
+
+def create_synthetic_values(n_rows: int, n_timepoints: int, sign_flip_rate: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Creates currents whose signs flip independently per row with probability `sign_flip_rate` between timepoints.
+
+    Parameters:
+        n_rows (int): The number of rows (edges or segment/itype pairs).
+        n_timepoints (int): The number of timepoints (columns).
+        sign_flip_rate (float): The probability of a sign change between neighbouring timepoints.
+        rng (np.random.Generator): The random generator.
+
+    Returns:
+        np.ndarray: The (row, timepoint) float64 values.
+    """
+    flips = rng.random((n_rows, n_timepoints)) < sign_flip_rate
+    flips[:, 0] = rng.random(n_rows) < 0.5
+    signs = np.where(np.cumsum(flips, axis=1) % 2 == 0, 1.0, -1.0)
+    magnitudes = rng.lognormal(mean=0.0, sigma=1.0, size=(n_rows, 1)) * rng.uniform(0.5, 1.5, size=(n_rows, n_timepoints))
+    return signs * magnitudes
+
+
+def write_synthetic_dataset(output_dir: str, n_segments: int = 200, branching: float = 0.1, itypes_per_segment: int = 4,
+                            n_timepoints: int = 100, sign_flip_rate: float = 0.01, n_files: int = 1, seed: int = 0) -> dict[str, str]:
+    """
+    Writes a synthetic dataset with the layout of the preprocessed data read by `main.py`.
+
+    The axial currents are written to `axial_currents_merged_soma` and the membrane currents to
+    `membrane_currents_merged_soma`, each as `multiindex_merged_soma.csv` plus `merged_soma_values_<i>.npy` files.
+
+    Parameters:
+        output_dir (str): The directory of the dataset (the `input_dir` of `main.py`).
+        n_segments (int): The number of segments, including the soma.
+        branching (float): The probability of starting a new branch, see `create_synthetic_tree`.
+        itypes_per_segment (int): The number of itypes of every segment other than the soma.
+        n_timepoints (int): The number of timepoints of every file.
+        sign_flip_rate (float): The probability of a sign change of a current between neighbouring timepoints.
+        n_files (int): The number of file pairs.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        dict[str, str]: The paths of the index files and value file patterns ("iax_index_file", "im_index_file",
+        "iax_dir", "im_dir").
+    """
+    rng = np.random.default_rng(seed)
+    iax_index = create_synthetic_tree(n_segments, branching, seed)
+    segments = ['soma'] + [f'dend{i}' for i in range(1, n_segments)]
+    im_index = create_synthetic_itypes(segments, itypes_per_segment, seed)
+
+    paths = {'iax_dir': os.path.join(output_dir, 'axial_currents_merged_soma'),
+             'im_dir': os.path.join(output_dir, 'membrane_currents_merged_soma')}
+    for name, index in (('iax', iax_index), ('im', im_index)):
+        os.makedirs(paths[f'{name}_dir'], exist_ok=True)
+        paths[f'{name}_index_file'] = os.path.join(paths[f'{name}_dir'], 'multiindex_merged_soma.csv')
+        index.to_frame(index=False).to_csv(paths[f'{name}_index_file'], index=False)
+
+    for i in range(n_files):
+        np.save(os.path.join(paths['iax_dir'], f'merged_soma_values_{i}.npy'),
+                create_synthetic_values(len(iax_index), n_timepoints, sign_flip_rate, rng))
+        np.save(os.path.join(paths['im_dir'], f'merged_soma_values_{i}.npy'),
+                create_synthetic_values(len(im_index), n_timepoints, sign_flip_rate, rng))
+    return paths
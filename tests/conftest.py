@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from partitioning_algorithm import partition_iax
+from synthetic_data import create_synthetic_itypes, create_synthetic_tree, create_synthetic_values
+
+
+@pytest.fixture(scope='session')
+def currents():
+    """Synthetic membrane and axial currents with sign flips and a few missing axial currents."""
+    rng = np.random.default_rng(0)
+    tree = create_synthetic_tree(40, 0.2, 0)
+    segments = ['soma'] + [f'dend{i}' for i in range(1, 40)]
+    itypes = create_synthetic_itypes(segments, 3, 0)
+    im = pd.DataFrame(create_synthetic_values(len(itypes), 12, 0.1, rng), index=itypes)
+    iax = pd.DataFrame(create_synthetic_values(len(tree), 12, 0.1, rng), index=tree)
+    iax.iloc[3, [1, 2]] = np.nan
+    iax.iloc[10, 2] = np.nan
+    return im, iax
+
+
+@pytest.fixture(scope='session')
+def reference(currents):
+    """The partitioned currents of the soma computed by the reference "pandas" engine."""
+    im, iax = currents
+    return partition_iax(im, iax, list(im.columns), 'soma', engine='pandas')
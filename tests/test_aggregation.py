@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+from utils import aggregate_currents, get_aggregation_codes, get_itotal_dataframes, get_soma_currents_dataframes
+
+
+def test_aggregate_currents_matches_separate_aggregations(currents):
+    im, iax = currents[0].copy(), currents[1].copy()
+    im.loc[[('soma', 'ic'), ('dend3', 'ic')], 3] = np.nan
+    iax.iloc[np.flatnonzero(iax.index.get_level_values('par') == 'soma')[0], 5] = np.nan
+    im_before, iax_before = im.copy(), iax.copy()
+
+    itotal_pos, itotal_neg, soma_pos, soma_neg = aggregate_currents(im, iax, get_aggregation_codes(im.index, iax.index))
+
+    expected = get_itotal_dataframes(im.copy()) + get_soma_currents_dataframes(im.copy(), iax.copy())
+    for result, expected_result in zip((itotal_pos, itotal_neg, soma_pos, soma_neg), expected):
+        pd.testing.assert_frame_equal(result, expected_result, check_names=False, rtol=1e-12)
+    pd.testing.assert_frame_equal(im, im_before)
+    pd.testing.assert_frame_equal(iax, iax_before)
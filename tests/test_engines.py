@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from partitioning_algorithm import partition_iax, partition_iax_multi, TimepointPool
+
+
+@pytest.mark.parametrize('engine, options', [
+    ('array', {}),
+    ('batched', {'block_size': 5}),
+    ('compact', {'block_size': 5}),
+    ('parallel', {'max_workers': 2, 'worker_engine': 'batched'}),
+])
+def test_engine_matches_pandas(currents, reference, engine, options):
+    im, iax = currents
+    part_pos, part_neg = partition_iax(im, iax, list(im.columns), 'soma', engine=engine, **options)
+    for part, expected in zip((part_pos, part_neg), reference):
+        np.testing.assert_array_equal(part.reindex(expected.index).to_numpy(), expected.to_numpy())
+
+
+def test_compact_unsorted_rows_match_pandas(currents, reference):
+    im, iax = currents
+    shuffled = im.iloc[np.random.default_rng(1).permutation(len(im))]
+    part_pos, part_neg = partition_iax(shuffled, iax, list(im.columns), 'soma', engine='compact', block_size=5)
+    for part, expected in zip((part_pos, part_neg), reference):
+        np.testing.assert_array_equal(part.reindex(expected.index).to_numpy(), expected.to_numpy())
+
+
+def test_multi_matches_array_for_every_target(currents):
+    im, iax = currents
+    targets = ['soma', 'dend1', 'dend7', 'dend20', 'dend39']
+    part_pos, part_neg = partition_iax_multi(im, iax, list(im.columns), targets=targets)
+    for target in targets:
+        expected = partition_iax(im, iax, list(im.columns), target, engine='array')
+        for part, target_expected in zip((part_pos, part_neg), expected):
+            np.testing.assert_allclose(part.loc[target].reindex(target_expected.index).to_numpy(), target_expected.to_numpy(),
+                                       rtol=1e-6, atol=1e-9)
+
+
+def test_timepoint_pool_matches_pandas(currents, reference):
+    im, iax = currents
+    with TimepointPool(im, iax, 'soma', 2, 'compact', block_size=5) as pool:
+        part_pos, part_neg = pool.partition(list(im.columns))
+    for part, expected in zip((part_pos, part_neg), reference):
+        np.testing.assert_array_equal(part.reindex(expected.index).to_numpy(), expected.to_numpy())
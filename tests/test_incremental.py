@@ -0,0 +1,55 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+from incremental import PreviousTable
+from output_writer import get_output_writer, read_output
+from sharding import OUTPUT_TABLES, get_table_path
+from synthetic_data import write_synthetic_dataset
+
+
+@pytest.mark.parametrize('output_format', ['npy', 'csv'])
+def test_incremental_reuses_unchanged_timepoints(tmp_path, monkeypatch, output_format):
+    paths = write_synthetic_dataset(str(tmp_path / 'input'), n_segments=30, n_timepoints=20, sign_flip_rate=0.1)
+    im_file, = glob.glob(os.path.join(paths['im_dir'], '*.npy'))
+    iax_file, = glob.glob(os.path.join(paths['iax_dir'], '*.npy'))
+    monkeypatch.setattr(main, 'incremental', True)
+    monkeypatch.setattr(main, 'output_format', output_format)
+    monkeypatch.setattr(main, 'window_timepoints', 8)
+
+    def run(output_dir):
+        return main.process_file_pair(im_file, iax_file, paths['im_index_file'], paths['iax_index_file'], str(output_dir))
+
+    assert run(tmp_path / 'incremental')['incremental'] == {'reused': 0, 'recomputed': 20}
+    im, iax = np.load(im_file), np.load(iax_file)
+    im[:, 3:5] *= 1.5
+    iax[:, 12] *= -1
+    np.save(im_file, im)
+    np.save(iax_file, iax)
+    assert run(tmp_path / 'incremental')['incremental'] == {'reused': 17, 'recomputed': 3}
+    assert run(tmp_path / 'incremental')['incremental'] == {'reused': 20, 'recomputed': 0}
+
+    monkeypatch.setattr(main, 'incremental', False)
+    run(tmp_path / 'full')
+    assert not os.path.exists(tmp_path / 'full' / 'fingerprints' / 'fingerprints_0.npz')
+    for name in OUTPUT_TABLES:
+        reused = read_output(get_table_path(str(tmp_path / 'incremental'), name, '0'))
+        recomputed = read_output(get_table_path(str(tmp_path / 'full'), name, '0'))
+        pd.testing.assert_frame_equal(reused, recomputed)
+
+
+def test_previous_table_memory_maps_the_chunks(tmp_path):
+    path = str(tmp_path / 'table')
+    with get_output_writer(path) as writer:
+        for start in (0, 3):
+            writer.append(pd.DataFrame(np.arange(6.0).reshape(2, 3) + start, columns=range(start, start + 3)))
+    previous = PreviousTable(path)
+    for chunk in previous.chunks:
+        while not isinstance(chunk, np.memmap):
+            assert chunk.base is not None, 'chunk is not memory-mapped'
+            chunk = chunk.base
+    np.testing.assert_array_equal(previous.get([4, 0]), [[4.0, 0.0], [7.0, 3.0]])
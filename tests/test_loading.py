@@ -0,0 +1,24 @@
+import glob
+import os
+
+import numpy as np
+
+from synthetic_data import write_synthetic_dataset
+from utils import load_df, load_df_mmap, load_index
+
+
+def test_load_df_mmap_matches_load_df(tmp_path):
+    paths = write_synthetic_dataset(str(tmp_path), n_segments=20, n_timepoints=5)
+    im_file, = glob.glob(os.path.join(paths['im_dir'], '*.npy'))
+    expected = load_df(paths['im_index_file'], im_file)
+    df = load_df_mmap(paths['im_index_file'], im_file)
+    assert df.index.equals(expected.index)
+    np.testing.assert_array_equal(df.to_numpy(), expected.to_numpy())
+    assert os.path.exists(paths['im_index_file'] + '.codes.npz')
+
+
+def test_load_index_without_writable_sidecar(tmp_path):
+    paths = write_synthetic_dataset(str(tmp_path), n_segments=20, n_timepoints=5)
+    (tmp_path / 'file').touch()
+    index = load_index(paths['im_index_file'], cache_dir=str(tmp_path / 'file' / 'cache'))
+    assert len(index) == len(load_index(paths['im_index_file']))
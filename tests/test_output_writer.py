@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from output_writer import get_output_writer, read_output
+
+
+def is_memory_mapped(values: np.ndarray) -> bool:
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+@pytest.mark.parametrize('output_format', ['npy', 'csv'])
+def test_read_output_round_trip(tmp_path, output_format):
+    index = pd.Index(['ina', 'ik', 'ipas'], name='itype')
+    chunks = [pd.DataFrame(np.random.default_rng(i).normal(size=(3, 4)), index=index, columns=range(4 * i, 4 * i + 4))
+              for i in range(3)]
+    path = str(tmp_path / 'table')
+    with get_output_writer(path, output_format) as writer:
+        for chunk in chunks:
+            writer.append(chunk)
+    pd.testing.assert_frame_equal(read_output(path), pd.concat(chunks, axis=1))
+
+
+def test_read_output_memory_maps_a_single_chunk(tmp_path):
+    df = pd.DataFrame(np.ones((2, 3)), index=pd.Index(['ina', 'ik'], name='itype'))
+    path = str(tmp_path / 'table')
+    with get_output_writer(path) as writer:
+        writer.append(df)
+    assert is_memory_mapped(read_output(path, mmap_mode='r').to_numpy())
+    pd.testing.assert_frame_equal(read_output(path, mmap_mode='r'), df)
+
+
+def test_empty_table(tmp_path):
+    path = str(tmp_path / 'table')
+    get_output_writer(path).close()
+    assert read_output(path).shape == (0, 0)
@@ -0,0 +1,45 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from partitioner import Partitioner
+from partitioning_algorithm import partition_iax
+from synthetic_data import write_synthetic_dataset
+from utils import load_df
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = write_synthetic_dataset(str(tmp_path / 'input'), n_segments=30, n_timepoints=20, sign_flip_rate=0.1)
+    im_file, = glob.glob(os.path.join(paths['im_dir'], '*.npy'))
+    iax_file, = glob.glob(os.path.join(paths['iax_dir'], '*.npy'))
+    return paths['im_index_file'], im_file, paths['iax_index_file'], iax_file
+
+
+def test_partitioner_serves_queries_from_memory_and_disk(files, tmp_path):
+    im_index_file, im_file, iax_index_file, iax_file = files
+    expected = partition_iax(load_df(im_index_file, im_file), load_df(iax_index_file, iax_file), list(range(20)), 'soma', engine='pandas')
+    cache_dir = str(tmp_path / 'cache')
+
+    partitioner = Partitioner(im_index_file, im_file, iax_index_file, iax_file, cache_dir=cache_dir)
+    part_pos, part_neg = partitioner.get_range(5, 10)
+    pd.testing.assert_frame_equal(part_pos, expected[0].loc[:, 5:9], check_names=False)
+    partitioner.get([12, 7, 5])
+    assert partitioner.cache_info()['hits'] == 2 and partitioner.cache_info()['misses'] == 6
+
+    # A new session reads the partitioned timepoints from disk
+    partitioner = Partitioner(im_index_file, im_file, iax_index_file, iax_file, cache_dir=cache_dir)
+    part_pos, part_neg = partitioner.get([12, 5, 0])
+    pd.testing.assert_frame_equal(part_neg, expected[1].loc[:, [12, 5, 0]], check_names=False)
+    assert partitioner.cache_info()['disk_hits'] == 2 and partitioner.cache_info()['misses'] == 1
+
+
+def test_partitioner_memory_is_bounded(files):
+    partitioner = Partitioner(*files)
+    column_bytes = sum(part.to_numpy().nbytes for part in partitioner.get([0]))
+    partitioner = Partitioner(*files, max_memory=3 * column_bytes)
+    partitioner.get_range(0, 20)
+    assert list(partitioner.columns) == [17, 18, 19] and partitioner.cache_info()['memory'] == 3 * column_bytes
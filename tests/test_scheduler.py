@@ -0,0 +1,28 @@
+import os
+
+from scheduler import pair_files, read_manifest, run_jobs
+
+
+def crash_or_square(value):
+    if value < 0:
+        os._exit(1)
+    return {'square': value * value}
+
+
+def test_dead_worker_only_fails_its_own_job(tmp_path):
+    manifest_path = str(tmp_path / 'jobs.jsonl')
+    jobs = [(str(value), (value,)) for value in [1, -1, 3, 4]]
+    results = run_jobs(jobs, crash_or_square, manifest_path, max_workers=2)
+    assert {result.job_id: result.status for result in results} == {'1': 'done', '-1': 'failed', '3': 'done', '4': 'done'}
+    assert results[2].details == {'square': 9}
+
+    results = run_jobs(jobs, crash_or_square, manifest_path, max_workers=2)
+    assert [result.status for result in results] == ['skipped', 'failed', 'skipped', 'skipped']
+    assert read_manifest(manifest_path)['-1']['status'] == 'failed'
+
+
+def test_pair_files_reports_unpaired_and_duplicate_keys():
+    pairs, unpaired = pair_files(['im/1.npy', 'im/2.npy', 'im/a3.npy', 'im/3.npy'], ['iax/1.npy', 'iax/3.npy', 'iax/4.npy'],
+                                 key=lambda f: ''.join(filter(str.isdigit, os.path.basename(f))))
+    assert pairs == [('1', 'im/1.npy', 'iax/1.npy')]
+    assert unpaired == ['iax/3.npy', 'iax/4.npy', 'im/2.npy', 'im/3.npy', 'im/a3.npy']
@@ -0,0 +1,64 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import main
+from output_writer import read_output
+from sharding import (SHARD_LOCK, check_shards, claim_shard, create_shard_manifest, get_shard_dir, get_table_path,
+                      merge_shards, release_shard)
+from synthetic_data import write_synthetic_dataset
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    write_synthetic_dataset(str(tmp_path / 'input'), n_segments=30, n_timepoints=20)
+    return create_shard_manifest(str(tmp_path / 'input'), str(tmp_path / 'output'), shard_size=8)
+
+
+def test_check_shards_reports_duplicates_and_overlaps(manifest):
+    assert [shard['shard_id'] for shard in manifest['shards']] == ['0_0-8', '0_8-16', '0_16-20']
+    first, second, third = manifest['shards']
+    overlapping = dict(second, shard_id='0_6-12', start=6, stop=12)
+    status = check_shards(dict(manifest, shards=[first, second, second, third, overlapping]))
+    assert status['duplicate'] == ['0_0-8', '0_6-12', '0_8-16']
+    assert status['missing'] == ['0_0-8', '0_8-16', '0_8-16', '0_16-20', '0_6-12']
+
+
+def test_run_merge_and_claims(manifest, tmp_path, monkeypatch):
+    # Synthetic currents may have no membrane current of the sign needed to partition an axial current
+    monkeypatch.setattr(main, 'conservation_tolerance', None)
+    shard_dir = get_shard_dir(manifest, '0_8-16')
+    assert claim_shard(shard_dir)
+    assert not claim_shard(shard_dir)
+    manifest_path = str(tmp_path / 'output' / 'shards.json')
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    results = main.run_shards(manifest_path)
+    assert [result.status for result in results] == ['done', 'claimed', 'done']
+    status = check_shards(manifest)
+    assert status['claimed'] == ['0_8-16'] and status['claims']['0_8-16']['pid'] == os.getpid()
+    with pytest.raises(ValueError):
+        merge_shards(manifest)
+
+    release_shard(shard_dir)
+    assert [result.status for result in main.run_shards(manifest_path)] == ['skipped', 'done', 'skipped']
+    assert not os.path.exists(os.path.join(shard_dir, SHARD_LOCK))
+    merge_shards(manifest)
+
+    full_dir = str(tmp_path / 'full')
+    shard = manifest['shards'][0]
+    main.process_file_pair(shard['im_file'], shard['iax_file'], manifest['im_index_file'], manifest['iax_index_file'], full_dir)
+    for name in ['im_part_pos', 'soma_neg', 'itotal_pos']:
+        pd.testing.assert_frame_equal(read_output(get_table_path(manifest['output_dir'], name, '0')),
+                                      read_output(get_table_path(full_dir, name, '0')), rtol=1e-12)
+
+
+def test_claim_of_a_dead_process_is_taken_over(tmp_path):
+    shard_dir = str(tmp_path / 'shard')
+    os.makedirs(shard_dir)
+    with open(os.path.join(shard_dir, SHARD_LOCK), 'w') as f:
+        json.dump({'host': os.uname().nodename, 'pid': 2 ** 22 + 1}, f)
+    assert claim_shard(shard_dir)
@@ -1,3 +1,8 @@
+import os
+import tempfile
+from dataclasses import dataclass
+from functools import lru_cache
+
 import pandas as pd
 import numpy as np
 from pandas import DataFrame
@@ -22,6 +27,83 @@ def load_df(index_fname: str, values_fname: str):
     return df
 
 
+def load_df_mmap(index_fname: str, values_fname: str, cache_dir: str = None) -> DataFrame:
+    """
+    Loads a DataFrame like `load_df`, with a cached multiindex and memory-mapped values.
+
+    The values are not read into memory: only the rows and columns accessed by the partitioning engines are read
+    from the .npy file. The values are read-only.
+
+    Parameters:
+        index_fname (str): The file path to the CSV file containing the multiindex data.
+        values_fname (str): The file path to the .npy file containing the array of values.
+        cache_dir (str, optional): The directory of the index cache, see `load_index`.
+
+    Returns:
+        pd.DataFrame: A pandas DataFrame backed by the memory-mapped values.
+    """
+    index = load_index(index_fname, cache_dir)
+    values = np.load(values_fname, mmap_mode='r')
+    df = pd.DataFrame(data=values, index=index, copy=False)
+    return df
+
+
+def load_index(index_fname: str, cache_dir: str = None) -> pd.MultiIndex:
+    """
+    Loads the multiindex from a CSV file, parsing it only once.
+
+    The integer codes and values of every level are cached in a binary sidecar (`<index_fname>.codes.npz`), which
+    is rebuilt whenever the size or modification time of the CSV file changes (and skipped if it cannot be written).
+    Within a process the multiindex is also kept in memory, so file pairs sharing an index file share the parsed index.
+
+    Parameters:
+        index_fname (str): The file path to the CSV file containing the multiindex data.
+        cache_dir (str, optional): The directory of the sidecar. Defaults to the directory of the CSV file.
+
+    Returns:
+        pd.MultiIndex: The same multiindex as built by `load_df`.
+    """
+    index_fname = os.path.abspath(index_fname)
+    stat = os.stat(index_fname)
+    return _load_index(index_fname, stat.st_size, stat.st_mtime_ns, cache_dir)
+
+
+@lru_cache(maxsize=8)
+def _load_index(index_fname: str, size: int, mtime_ns: int, cache_dir: str) -> pd.MultiIndex:
+    cache_dir = cache_dir if cache_dir is not None else os.path.dirname(index_fname)
+    sidecar = os.path.join(cache_dir, os.path.basename(index_fname) + '.codes.npz')
+    key = np.array([size, mtime_ns], dtype=np.int64)
+
+    if os.path.exists(sidecar):
+        with np.load(sidecar, allow_pickle=False) as cached:
+            if np.array_equal(cached['key'], key):
+                n_levels = len(cached['names'])
+                return pd.MultiIndex(levels=[cached[f'levels_{i}'] for i in range(n_levels)],
+                                     codes=[cached[f'codes_{i}'] for i in range(n_levels)],
+                                     names=list(cached['names']))
+
+    multiindex = pd.MultiIndex.from_frame(pd.read_csv(index_fname))
+    arrays = {'key': key, 'names': np.array(multiindex.names, dtype=str)}
+    for i, (level, codes) in enumerate(zip(multiindex.levels, multiindex.codes)):
+        level_values = np.asarray(level)
+        arrays[f'levels_{i}'] = level_values.astype(str) if level_values.dtype == object else level_values
+        arrays[f'codes_{i}'] = np.asarray(codes, dtype=np.int32)
+
+    # Write to a temporary file first, so concurrent workers never read a partial sidecar. The sidecar is only a
+    # cache, so a directory that cannot be written (read-only or shared inputs, quotas) keeps the parsed index
+    tmp_name = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npz', delete=False) as tmp:
+            tmp_name = tmp.name
+            np.savez(tmp, **arrays)
+        os.replace(tmp_name, sidecar)
+    except OSError:
+        if tmp_name is not None and os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return multiindex
+
+
 def get_iax(df: DataFrame, segment: str) -> DataFrame:
     """
     Extracts axial currents associated with a specific segment from a DataFrame.
@@ -55,7 +137,7 @@ def get_itotal_dataframes(df_im: DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]
 
    Parameters:
        df_im (pd.DataFrame):
-           A DataFrame containing membrane currents with 'itype' and 'segment' columns.
+           A DataFrame containing membrane currents indexed by 'segment' and 'itype'.
 
    Returns:
        tuple[pd.DataFrame, pd.DataFrame]:
@@ -63,9 +145,7 @@ def get_itotal_dataframes(df_im: DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]
            - The first DataFrame (`itotal_pos`) contains the sum of positive currents for each type.
            - The second DataFrame (`itotal_neg`) contains the sum of negative currents for each type.
    """
-    df_im.reset_index(inplace=True)
-    df_im.drop('segment', axis=1, inplace=True)
-    sum_by_type = df_im.groupby('itype').sum()
+    sum_by_type = df_im.groupby(level='itype').sum()
     itotal_pos = sum_by_type[sum_by_type >= 0].fillna(0)
     itotal_neg = sum_by_type[sum_by_type < 0].fillna(0)
     return itotal_pos, itotal_neg
@@ -115,6 +195,182 @@ def get_soma_currents_dataframes(im: DataFrame, iax:DataFrame) -> tuple[pd.DataF
     return soma_pos, soma_neg
 
 
+@dataclass(frozen=True)
+class AggregationCodes:
+    """
+    Integer group codes of the membrane and axial current rows used by `aggregate_currents`.
+
+    Attributes:
+        segment (str): The segment whose membrane and axial currents are aggregated (e.g. 'soma').
+        itypes (pd.Index): The sorted itype names, the rows of the total currents.
+        itype_codes (np.ndarray): The position in `itypes` of every membrane current row.
+        itype_operator (np.ndarray): The (itype, membrane current row) indicator matrix summing the rows of every itype.
+        segment_rows (np.ndarray): The membrane current rows of the segment.
+        segment_itypes (pd.Index): The itypes of these rows.
+        iax_rows (np.ndarray): The axial current rows of the edges of the segment, rows with the segment as ref first.
+        iax_signs (np.ndarray): The sign of these rows from the perspective of the segment (-1 as ref, 1 as par).
+    """
+    segment: str
+    itypes: pd.Index
+    itype_codes: np.ndarray
+    itype_operator: np.ndarray
+    segment_rows: np.ndarray
+    segment_itypes: pd.Index
+    iax_rows: np.ndarray
+    iax_signs: np.ndarray
+
+
+def get_aggregation_codes(im_index: pd.MultiIndex, iax_index: pd.MultiIndex, segment: str = 'soma') -> AggregationCodes:
+    """
+    Computes the group codes of `aggregate_currents` once for the indices of a dataset.
+
+    Parameters:
+        im_index (pd.MultiIndex): The ('segment', 'itype') index of the membrane currents.
+        iax_index (pd.MultiIndex): The ('ref', 'par') index of the axial currents.
+        segment (str): The segment whose membrane and axial currents are aggregated.
+
+    Returns:
+        AggregationCodes: The group codes of the rows.
+    """
+    itype_codes, itypes = pd.factorize(im_index.get_level_values('itype'), sort=True)
+    itype_operator = np.zeros((len(itypes), len(im_index)), dtype=bool)
+    itype_operator[itype_codes, np.arange(len(im_index))] = True
+
+    segment_rows = np.flatnonzero(im_index.get_level_values('segment') == segment)
+    ref_rows = np.flatnonzero(iax_index.get_level_values('ref') == segment)
+    par_rows = np.flatnonzero(iax_index.get_level_values('par') == segment)
+    iax_signs = np.concatenate([np.full(len(ref_rows), -1, dtype=np.int8), np.ones(len(par_rows), dtype=np.int8)])
+
+    return AggregationCodes(segment, pd.Index(itypes, name='itype'), itype_codes, itype_operator, segment_rows,
+                            im_index[segment_rows].droplevel('segment'), np.concatenate([ref_rows, par_rows]), iax_signs)
+
+
+def aggregate_currents(im: DataFrame, iax: DataFrame, codes: AggregationCodes) -> tuple[DataFrame, DataFrame, DataFrame, DataFrame]:
+    """
+    Computes the results of `get_itotal_dataframes` and `get_soma_currents_dataframes` in a single pass over the
+    values, without modifying or copying `im` and `iax`.
+
+    The per-itype sums are a single product of the itype indicator matrix with the membrane currents. Only the rows of
+    the segment and of its axial currents are gathered.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for all segments and timepoints.
+        iax (DataFrame): A DataFrame containing axial currents for all segments and timepoints.
+        codes (AggregationCodes): The group codes of the indices of `im` and `iax`, see `get_aggregation_codes`.
+
+    Returns:
+        tuple[DataFrame, DataFrame, DataFrame, DataFrame]: `itotal_pos` and `itotal_neg` as returned by
+        `get_itotal_dataframes`, followed by the positive and negative segment currents as returned by
+        `get_soma_currents_dataframes` (with `<segment>_iax_pos` and `<segment>_iax_neg` as the axial rows).
+    """
+    im_values = im.to_numpy()
+    sum_by_type = codes.itype_operator.astype(im_values.dtype) @ im_values
+    # NaN propagates through the product, the affected timepoints are summed skipping NaN as in `groupby().sum()`
+    invalid = np.flatnonzero(np.isnan(sum_by_type).any(axis=0))
+    if len(invalid):
+        sum_by_type[:, invalid] = DataFrame(im_values[:, invalid]).groupby(codes.itype_codes).sum().to_numpy()
+    itotal_pos = DataFrame(np.where(sum_by_type >= 0, sum_by_type, 0), index=codes.itypes, columns=im.columns)
+    itotal_neg = DataFrame(np.where(sum_by_type < 0, sum_by_type, 0), index=codes.itypes, columns=im.columns)
+    segment_pos, segment_neg = get_segment_currents(im, iax, codes)
+    return itotal_pos, itotal_neg, segment_pos, segment_neg
+
+
+def get_segment_currents(im: DataFrame, iax: DataFrame, codes: AggregationCodes) -> tuple[DataFrame, DataFrame]:
+    """
+    Computes the result of `get_soma_currents_dataframes` for the segment of `codes`, gathering only its rows.
+
+    Parameters:
+        im (DataFrame): A DataFrame containing membrane currents for all segments and timepoints.
+        iax (DataFrame): A DataFrame containing axial currents for all segments and timepoints.
+        codes (AggregationCodes): The group codes of the indices of `im` and `iax`, see `get_aggregation_codes`.
+
+    Returns:
+        tuple[DataFrame, DataFrame]: The positive and negative membrane currents of the segment, followed by the
+        summed positive (`<segment>_iax_pos`) and negative (`<segment>_iax_neg`) axial currents as last row.
+    """
+    im_values = im.to_numpy()
+    iax_values = iax.to_numpy()
+    segment_im = im_values[codes.segment_rows]
+    segment_iax = iax_values[codes.iax_rows] * codes.iax_signs[:, None]
+    segment_index = codes.segment_itypes.append(pd.Index([f'{codes.segment}_iax_pos']))
+    segment_pos = DataFrame(np.vstack([np.where(segment_im >= 0, segment_im, 0),
+                                       np.where(segment_iax >= 0, segment_iax, 0).sum(axis=0)]),
+                            index=segment_index, columns=im.columns)
+    segment_index = codes.segment_itypes.append(pd.Index([f'{codes.segment}_iax_neg']))
+    segment_neg = DataFrame(np.vstack([np.where(segment_im < 0, segment_im, 0),
+                                       np.where(segment_iax < 0, segment_iax, 0).sum(axis=0)]),
+                            index=segment_index, columns=im.columns)
+    return segment_pos, segment_neg
+
+
+def get_conservation_sums(im_part_pos: DataFrame, im_part_neg: DataFrame, segment_pos: DataFrame, segment_neg: DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sums the partitioned currents of a segment and the membrane plus axial currents of the segment at every timepoint.
+    Both sums agree if the partitioning conserves the currents of the segment.
+
+    Parameters:
+        im_part_pos (DataFrame): The partitioned positive membrane currents of the segment (see `partition_iax`).
+        im_part_neg (DataFrame): The partitioned negative membrane currents of the segment.
+        segment_pos (DataFrame): The positive membrane and axial currents of the segment at the same timepoints
+                                 (see `get_segment_currents`).
+        segment_neg (DataFrame): The negative membrane and axial currents of the segment at the same timepoints.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The (sign, timepoint) sums of the partitioned currents (NaN skipped) and of the
+        membrane plus axial currents, with the positive currents in the first row.
+    """
+    partitioned = np.stack([np.nansum(im_part_pos.to_numpy(), axis=0), np.nansum(im_part_neg.to_numpy(), axis=0)])
+    expected = np.stack([segment_pos.to_numpy().sum(axis=0), segment_neg.to_numpy().sum(axis=0)])
+    return partitioned, expected
+
+
+def get_conservation_errors(im_part_pos: DataFrame, im_part_neg: DataFrame, segment_pos: DataFrame, segment_neg: DataFrame) -> np.ndarray:
+    """
+    Computes the relative errors of the identity plotted by `plot_sums` at every timepoint.
+
+    Parameters:
+        See `get_conservation_sums`.
+
+    Returns:
+        np.ndarray: The (sign, timepoint) relative errors |partitioned - expected| / |expected| of the positive and
+        negative currents (0 where both sums are equal, inf where only the expected sum is 0).
+    """
+    partitioned, expected = get_conservation_sums(im_part_pos, im_part_neg, segment_pos, segment_neg)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        errors = np.abs(partitioned - expected) / np.abs(expected)
+    return np.where(partitioned == expected, 0.0, errors)
+
+
+def check_conservation(errors: np.ndarray, tolerance: float = None, strict: bool = True) -> dict:
+    """
+    Summarizes the relative errors of the conservation identity and fails if they exceed the tolerance.
+
+    Parameters:
+        errors (np.ndarray): The (sign, timepoint) relative errors, see `get_conservation_errors`.
+        tolerance (float, optional): The maximum allowed relative error. If None, the errors are only reported.
+        strict (bool): Whether to raise if the errors exceed the tolerance, otherwise this is only recorded in the
+                       summary.
+
+    Returns:
+        dict: The number of timepoints with the maximum and mean relative error and, with a tolerance, the tolerance
+        and whether the errors are within it ("passed").
+
+    Raises:
+        ValueError: If `strict` and the maximum relative error exceeds `tolerance`.
+    """
+    n_timepoints = errors.shape[-1]
+    summary = {'n_timepoints': n_timepoints,
+               'max_relative_error': float(errors.max()) if n_timepoints else 0.0,
+               'mean_relative_error': float(errors.mean()) if n_timepoints else 0.0}
+    if tolerance is not None:
+        summary.update(tolerance=tolerance, passed=bool(summary['max_relative_error'] <= tolerance))
+    if strict and not summary.get('passed', True):
+        raise ValueError(f"Partitioned currents violate the conservation identity: maximum relative error "
+                         f"{summary['max_relative_error']:.3g} (mean {summary['mean_relative_error']:.3g}) exceeds "
+                         f"the tolerance {tolerance:.3g}")
+    return summary
+
+
 def plot_sums(im_part_pos: pd.DataFrame, im_part_neg: pd.DataFrame, df_im: pd.DataFrame, df_iax: pd.DataFrame, tps: list, segment: str) -> None:
     """
     Plots the comparison of partitioned and original membrane currents for a specific segment over timepoints.
@@ -143,39 +399,27 @@ def plot_sums(im_part_pos: pd.DataFrame, im_part_neg: pd.DataFrame, df_im: pd.Da
 
     Notes:
         - Positive currents are those with values >= 0, and negative currents are those with values < 0.
+        - `get_conservation_errors` and `check_conservation` check the same identity without plotting.
     """
-    df_im_part_calculated_pos = im_part_pos
-    df_im_part_calculated_neg = im_part_neg
-    df_im_part_calculated_pos_sum = df_im_part_calculated_pos.sum(axis=0).values
-    df_im_part_calculated_neg_sum = df_im_part_calculated_neg.sum(axis=0).values
-
-    df_im_original = df_im.iloc[:, tps].loc[segment]
-    df_im_original_pos = df_im_original[df_im_original >= 0].fillna(0)
-    df_im_original_neg = df_im_original[df_im_original < 0].fillna(0)
-    df_im_original_pos_sum = df_im_original_pos.sum(axis=0).values
-    df_im_original_neg_sum = df_im_original_neg.sum(axis=0).values
-
-    df_iax_original = get_iax(df_iax, segment).iloc[:, tps]
-    df_iax_original_pos = df_iax_original[df_iax_original >= 0].fillna(0)
-    df_iax_original_neg = df_iax_original[df_iax_original < 0].fillna(0)
-    df_iax_original_pos_sum = df_iax_original_pos.sum(axis=0).values
-    df_iax_original_neg_sum = df_iax_original_neg.sum(axis=0).values
+    codes = get_aggregation_codes(df_im.index, df_iax.index, segment)
+    segment_pos, segment_neg = get_segment_currents(df_im.iloc[:, tps], df_iax.iloc[:, tps], codes)
+    partitioned, expected = get_conservation_sums(im_part_pos, im_part_neg, segment_pos, segment_neg)
 
     # Plotting
     import matplotlib.pyplot as plt
     fig, axes = plt.subplots(2, 1, figsize=(12, 6), sharex=True)
 
     # Positive values
-    axes[0].plot(df_im_part_calculated_pos_sum, label="partitioned", marker='o')
-    axes[0].plot(df_im_original_pos_sum + df_iax_original_pos_sum, label="membrane + axial", marker='x')
+    axes[0].plot(partitioned[0], label="partitioned", marker='o')
+    axes[0].plot(expected[0], label="membrane + axial", marker='x')
     axes[0].set_title("positive currents")
     axes[0].set_xlabel("timepoints")
     axes[0].set_ylabel("sum of positive currents")
     axes[0].legend()
 
     # Negative values
-    axes[1].plot(df_im_part_calculated_neg_sum, label="partitioned", marker='o')
-    axes[1].plot(df_im_original_neg_sum + df_iax_original_neg_sum, label="membrane + axial", marker='x')
+    axes[1].plot(partitioned[1], label="partitioned", marker='o')
+    axes[1].plot(expected[1], label="membrane + axial", marker='x')
     axes[1].set_title("negative currents")
     axes[1].set_xlabel("timepoints")
     axes[1].legend()
@@ -184,4 +428,6 @@ def plot_sums(im_part_pos: pd.DataFrame, im_part_neg: pd.DataFrame, df_im: pd.Da
     plt.show()
 
 if __name__ == '__main__':
-    df = pd.read_csv('E:/cluster_seed30/partitioned_data/soma/soma_neg_0.csv')
+    from output_writer import read_output
+
+    df = read_output('E:/cluster_seed30/partitioned_data/soma_currents/soma_neg_0')